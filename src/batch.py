@@ -0,0 +1,147 @@
+import sys, os, json, time, argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, IO, Iterator, List
+from gi.repository import Gio, GLib
+from .constants import AVAILABLE_LLMS
+from .llm import LLMHandler
+from .usage import UsageTracker, count_prompt_tokens, default_usage_path
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def load_configured_handler(settings: Gio.Settings) -> LLMHandler:
+    """Create and load the LLM handler selected in the settings, like the main window does."""
+    directory: str = GLib.get_user_config_dir()
+    sys.path.append(os.path.join(directory, "pip"))
+    language_model: str = settings.get_string("language-model")
+    model: Dict = AVAILABLE_LLMS.get(language_model, list(AVAILABLE_LLMS.values())[0])
+    handler: LLMHandler = model["class"](settings, os.path.join(directory, "models"))
+    handler.load_model(settings.get_string("local-model"))
+    # Batch calls are recorded with the ones of the window, and measured with the tokens the provider reports
+    handler.usage_tracker = UsageTracker(default_usage_path())
+    return handler
+
+
+def check_item(item: Dict) -> str | None:
+    """Return what is wrong with an item, None if it can be run"""
+    if not isinstance(item.get("prompt"), str):
+        return "\"prompt\" must be a string"
+    history = item.get("history", [])
+    if not isinstance(history, list) or not all(isinstance(m, dict) and isinstance(m.get("User"), str)
+                                                and isinstance(m.get("Message"), str) for m in history):
+        return "\"history\" must be a list of {\"User\", \"Message\"} objects"
+    system = item.get("system", [])
+    if not isinstance(system, list) or not all(isinstance(p, str) for p in system):
+        return "\"system\" must be a string or a list of strings"
+    return None
+
+
+def read_items(file: IO) -> Iterator[Dict]:
+    """Yield the items of a JSONL file, a line can be an object with a "prompt" key or just a string.
+
+    Invalid lines are reported and skipped.
+    """
+    for number, line in enumerate(file):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            logging.error(f"Skipping line {number + 1}: {e}")
+            continue
+        if isinstance(item, str):
+            item = {"prompt": item}
+        elif not isinstance(item, dict):
+            logging.error(f"Skipping line {number + 1}: expected an object or a string")
+            continue
+        if isinstance(item.get("system"), str):
+            item["system"] = [item["system"]]
+        error: str | None = check_item(item)
+        if error is not None:
+            logging.error(f"Skipping line {number + 1}: {error}")
+            continue
+        item.setdefault("id", number)
+        yield item
+
+
+def is_error(response: str) -> bool:
+    """Handlers return errors as message text"""
+    return response.startswith("Error")
+
+
+def run_item(handler: LLMHandler, item: Dict, retries: int, retry_delay: float) -> Dict:
+    history: List[Dict] = item.get("history", [])
+    system_prompt: List[str] = item.get("system", [])
+    result: Dict[str, Any] = {"id": item["id"]}
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        handler.thread_usage.value = None
+        try:
+            # Through the rate limiter like the requests of the window, rate limits are retried there
+            response: str = handler.schedule(handler.measure, "batch", None, item["prompt"], history, system_prompt,
+                                             lambda _: handler.generate_text(item["prompt"], history, system_prompt))
+            error: str | None = response if is_error(response) else None
+        except Exception as e:
+            response, error = "", str(e)
+        if error is None or attempt == retries:
+            break
+        logging.warning(f"Item {item['id']} failed (attempt {attempt + 1}): {error}")
+        time.sleep(retry_delay * 2 ** attempt)
+    result["latency"] = round(time.perf_counter() - start, 3)
+    result["attempts"] = attempt + 1
+    usage: Dict | None = handler.thread_usage.value
+    if usage is not None:
+        result["prompt_tokens"] = usage["prompt_tokens"]
+        result["estimated"] = usage["estimated"]
+    else:
+        # The call raised before its usage was measured
+        result["prompt_tokens"] = count_prompt_tokens(item["prompt"], history, system_prompt)
+        result["estimated"] = True
+    if error is None:
+        result["response"] = response
+        if usage is not None:
+            result["completion_tokens"] = usage["completion_tokens"]
+    else:
+        result["error"] = error
+    return result
+
+
+def run_batch(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="newelle --batch",
+                                     description="Run the prompts of a JSONL file through the configured LLM")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="JSONL file with one {\"prompt\", \"history\", \"system\", \"id\"} object per line, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL file where the results are written, - for stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of prompts running at the same time")
+    parser.add_argument("--retries", type=int, default=2, help="How many times a failed prompt is retried")
+    parser.add_argument("--retry-delay", type=float, default=1, help="Seconds before the first retry, doubled each time")
+    args = parser.parse_args(argv)
+
+    try:
+        input_file: IO = sys.stdin if args.input == "-" else open(args.input, "r")
+    except OSError as e:
+        parser.error(f"cannot read {args.input}: {e.strerror}")
+    try:
+        output_file: IO = sys.stdout if args.output == "-" else open(args.output, "w")
+    except OSError as e:
+        parser.error(f"cannot write {args.output}: {e.strerror}")
+    handler = load_configured_handler(Gio.Settings.new('io.github.qwersyk.Newelle'))
+    failed: int = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            futures = [executor.submit(run_item, handler, item, args.retries, args.retry_delay)
+                       for item in read_items(input_file)]
+            for future in as_completed(futures):
+                result = future.result()
+                failed += "error" in result
+                output_file.write(json.dumps(result) + "\n")
+                output_file.flush()
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    return 1 if failed else 0
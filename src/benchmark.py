@@ -0,0 +1,191 @@
+import sys, json, time, statistics, tracemalloc, argparse
+import multiprocessing
+from typing import Any, Callable, Dict, List, Tuple
+from .llm import LLMHandler, OllamaHandler, OpenAIHandler, CustomLLMHandler, GPT3AnyHandler, AirforceHandler, NexraHandler
+from .benchmark_servers import serve
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SCENARIOS: Dict[str, Dict] = {
+    # A realistic answer with provider latency: measures what the handler adds to time to first token
+    "latency": {"tokens": 50, "token": "tok ", "first_token_delay": 0.2, "token_interval": 0.005},
+    # Tokens as fast as the server can write them: measures the handler's own cost per chunk
+    "throughput": {"tokens": 2000, "token": "tok ", "first_token_delay": 0, "token_interval": 0},
+}
+
+# Metrics where a higher value is better, the others are costs
+HIGHER_IS_BETTER = {"tokens_per_second"}
+
+
+class MemorySettings:
+    """Stand-in for Gio.Settings keeping the handler settings in memory"""
+
+    def __init__(self):
+        self.values: Dict[str, str] = {}
+
+    def get_string(self, key: str) -> str:
+        return self.values.get(key, "{}")
+
+    def set_string(self, key: str, value: str):
+        self.values[key] = value
+
+
+class StandInServer:
+    """Scripted OpenAI/Ollama server running in a separate process, so its CPU time is not measured"""
+
+    def __init__(self, script: Dict):
+        context = multiprocessing.get_context("spawn")
+        port_queue = context.Queue()
+        self.process = context.Process(target=serve, args=(script, port_queue), daemon=True)
+        self.process.start()
+        self.url = f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def openai_client(url: str):
+    import openai
+    return openai.OpenAI(base_url=url + "/v1/", api_key="benchmark")
+
+
+def create_handler(name: str, url: str) -> LLMHandler:
+    """Create a handler of the given kind talking to the stand-in server at url."""
+    settings = MemorySettings()
+    if name == "ollama":
+        handler = OllamaHandler(settings, "")
+        handler.set_setting("endpoint", url)
+    elif name == "openai":
+        handler = OpenAIHandler(settings, "")
+        handler.set_setting("endpoint", url + "/v1/")
+        handler.set_setting("api", "benchmark")
+        handler.set_setting("advanced_params", False)
+    elif name == "custom_command":
+        handler = CustomLLMHandler(settings, "")
+        handler.set_setting("command", f"curl -sN {url}/")
+    elif name in ("GPT3Any", "airforce", "nexra"):
+        handler = {"GPT3Any": GPT3AnyHandler, "airforce": AirforceHandler, "nexra": NexraHandler}[name](settings, "")
+        # g4f clients share the OpenAI client interface, pointing it to the server measures only the handler loop
+        handler.client = openai_client(url)
+    else:
+        raise ValueError(f"Unknown handler {name}")
+    handler.set_setting("model", "benchmark")
+    handler.set_setting("streaming", True)
+    return handler
+
+
+def run_stream(handler: LLMHandler) -> Tuple[float | None, int, str]:
+    """Send a message through send_message_stream, returns time to first update, updates and the answer."""
+    updates: int = 0
+    first: float | None = None
+    start = time.perf_counter()
+
+    def on_update(message: str):
+        nonlocal updates, first
+        if first is None:
+            first = time.perf_counter() - start
+        updates += 1
+
+    answer: str = handler.send_message_stream(None, "Benchmark", on_update)
+    return first, updates, answer
+
+
+def measure(handler: LLMHandler, scenario: Dict, runs: int) -> Dict[str, float]:
+    """Measure one handler on one scenario, returning the median of the runs."""
+    ttft: List[float] = []
+    cpu_per_chunk: List[float] = []
+    tokens_per_second: List[float] = []
+    expected: str = (scenario["token"] * scenario["tokens"]).strip()
+    for _run in range(runs):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        first, updates, answer = run_stream(handler)
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+        if answer.split() != expected.split() or first is None:
+            raise RuntimeError(f"Unexpected answer: {answer[:80]}")
+        ttft.append(first - scenario["first_token_delay"])
+        cpu_per_chunk.append(cpu / scenario["tokens"])
+        tokens_per_second.append(scenario["tokens"] / wall)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    run_stream(handler)
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # Memory blocks still allocated after the stream, the ones freed during it are not counted
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    return {
+        "ttft_overhead_ms": round(statistics.median(ttft) * 1000, 3),
+        "cpu_per_chunk_us": round(statistics.median(cpu_per_chunk) * 1e6, 3),
+        "tokens_per_second": round(statistics.median(tokens_per_second), 1),
+        "retained_blocks": retained_blocks,
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(handlers: List[str], scenarios: List[str], runs: int) -> Dict[str, Dict[str, Dict]]:
+    results: Dict[str, Dict[str, Dict]] = {}
+    for scenario_name in scenarios:
+        server = StandInServer(SCENARIOS[scenario_name])
+        try:
+            for name in handlers:
+                try:
+                    result = measure(create_handler(name, server.url), SCENARIOS[scenario_name], runs)
+                except Exception as e:
+                    logging.error(f"Skipping {name} on {scenario_name}: {e}")
+                    continue
+                results.setdefault(name, {})[scenario_name] = result
+                logging.info(f"{name} {scenario_name}: {result}")
+        finally:
+            server.stop()
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Return the metrics that regressed by more than tolerance (a fraction) against the baseline."""
+    regressions: List[str] = []
+    for name, scenarios in results.items():
+        for scenario_name, metrics in scenarios.items():
+            reference: Dict = baseline.get(name, {}).get(scenario_name, {})
+            for metric, value in metrics.items():
+                if metric not in reference or not reference[metric]:
+                    continue
+                change: float = (value - reference[metric]) / abs(reference[metric])
+                if metric in HIGHER_IS_BETTER:
+                    change = -change
+                if change > tolerance:
+                    regressions.append(f"{name} {scenario_name} {metric}: {reference[metric]} -> {value}")
+    return regressions
+
+
+def run_benchmark_cli(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="newelle --benchmark",
+                                     description="Measure LLM handler overhead against local stand-in servers")
+    parser.add_argument("--handlers", default="ollama,openai,custom_command,GPT3Any,airforce,nexra",
+                        help="Comma separated handler keys to benchmark")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios to run")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per handler and scenario, the median is reported")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file, usable as a baseline")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baseline (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.handlers.split(","), args.scenarios.split(","), args.runs)
+    output: str = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
@@ -0,0 +1,104 @@
+import json, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class ScriptedStreamHandler(BaseHTTPRequestHandler):
+    """Stand-in for OpenAI-compatible and Ollama APIs, answering every request with a scripted token stream.
+
+    The script is set on the server: tokens (number of tokens), token (text of each token),
+    first_token_delay and token_interval (seconds).
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def _tokens(self):
+        script: Dict = self.server.script
+        time.sleep(script["first_token_delay"])
+        for i in range(script["tokens"]):
+            if i > 0 and script["token_interval"]:
+                time.sleep(script["token_interval"])
+            yield script["token"]
+
+    def _start_chunked(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data: str):
+        encoded = data.encode()
+        self.wfile.write(f"{len(encoded):x}\r\n".encode() + encoded + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, data: Dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # Plain text stream, one token per line, for command based handlers (curl)
+        self._start_chunked("text/plain")
+        for token in self._tokens():
+            self._write_chunk(token + "\n")
+        self._end_chunked()
+
+    def do_POST(self):
+        request: Dict = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.rstrip("/").endswith("/api/chat"):
+            self._ollama_chat(request)
+        else:
+            self._openai_chat(request)
+
+    def _openai_chat(self, request: Dict):
+        model: str = request.get("model", "")
+        if not request.get("stream"):
+            content = "".join(self._tokens())
+            self._send_json({"id": "bench", "object": "chat.completion", "created": 0, "model": model,
+                             "choices": [{"index": 0, "finish_reason": "stop",
+                                          "message": {"role": "assistant", "content": content}}]})
+            return
+        self._start_chunked("text/event-stream")
+        for token in self._tokens():
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            self._write_chunk("data: " + json.dumps(chunk) + "\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self._end_chunked()
+
+    def _ollama_chat(self, request: Dict):
+        model: str = request.get("model", "")
+        if not request.get("stream", True):
+            content = "".join(self._tokens())
+            self._send_json({"model": model, "created_at": "", "done": True,
+                             "message": {"role": "assistant", "content": content}})
+            return
+        self._start_chunked("application/x-ndjson")
+        for token in self._tokens():
+            self._write_chunk(json.dumps({"model": model, "created_at": "", "done": False,
+                                          "message": {"role": "assistant", "content": token}}) + "\n")
+        self._write_chunk(json.dumps({"model": model, "created_at": "", "done": True,
+                                      "message": {"role": "assistant", "content": ""}}) + "\n")
+        self._end_chunked()
+
+
+def serve(script: Dict, port_queue: object):
+    """Run the stand-in server on a free local port, sending the port through port_queue."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedStreamHandler)
+    server.daemon_threads = True
+    server.script = script
+    port_queue.put(server.server_port)
+    server.serve_forever()
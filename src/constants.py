@@ -1,4 +1,5 @@
 
+from .replay import ReplayHandler
 from .llm import AirforceHandler, GPT4AllHandler, GroqHandler, NexraHandler, OllamaHandler, OpenAIHandler, CustomLLMHandler, GPT3AnyHandler, GeminiHandler, MistralHandler, OpenRouterHandler
 from .tts import gTTSHandler, EspeakHandler, CustomTTSHandler
 from .stt import SphinxHandler, GoogleSRHandler, WitAIHandler, VoskHandler, WhisperAPIHandler, CustomSRHandler
@@ -74,6 +75,13 @@ AVAILABLE_LLMS = {
         "description": _("Use the output of a custom command"),
         "class": CustomLLMHandler,
         "secondary": True
+    },
+    "replay": {
+        "key": "replay",
+        "title": _("Stream Replay"),
+        "description": _("Replay streams recorded with NEWELLE_RECORD_STREAMS, for offline performance runs"),
+        "class": ReplayHandler,
+        "secondary": True
     }
 }
 
@@ -0,0 +1,280 @@
+import os, json, threading, time, hashlib
+from typing import Any, Callable, Dict, List, Tuple
+import requests
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a download when it has been cancelled."""
+
+
+class ChecksumError(Exception):
+    """Raised when a downloaded file does not match the expected checksum."""
+
+
+class Download:
+    """A file being downloaded by the DownloadManager.
+
+    The data is written to destination + ".part" and moved to destination only once it is complete
+    and verified. When the download is split in segments, their progress is kept in
+    destination + ".part.json" so that an interrupted download can be resumed.
+    """
+
+    def __init__(self, url: str, destination: str, checksum: str | None = None, algorithm: str = "sha256",
+                 connections: int = 1, on_progress: Callable[[int, int], Any] = lambda done, total: None,
+                 on_done: Callable[["Download"], Any] = lambda download: None,
+                 chunk_size: int = 1024 * 256, timeout: float = 30, progress_interval: float = 0.1):
+        self.url = url
+        self.destination = destination
+        self.part_path = destination + ".part"
+        self.state_path = destination + ".part.json"
+        self.checksum = checksum.lower() if checksum else None
+        self.algorithm = algorithm
+        self.connections = max(1, connections)
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.progress_interval = progress_interval
+        self.total: int = 0
+        self.downloaded: int = 0
+        self.error: Exception | None = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        # Set under _lock, so that the partial data is removed exactly once, by cancel or by the thread
+        self._finished: bool = False
+        self._remove: bool = False
+        self._last_progress: float = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def fraction(self) -> float:
+        return self.downloaded / self.total if self.total else 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self, remove: bool = False):
+        """Stop the download without waiting for it, use wait for that.
+
+        The partial data is kept to resume later unless remove is True, in which case it is removed
+        by the download thread once it stopped writing it.
+        """
+        self._cancelled.set()
+        if not remove:
+            return
+        with self._lock:
+            self._remove = True
+            finished: bool = self._finished or not self.thread.is_alive()
+        if finished:
+            self.remove_partial()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait for the download to end, returns True if it completed successfully."""
+        self.thread.join(timeout)
+        return not self.thread.is_alive() and self.error is None and not self.cancelled
+
+    def remove_partial(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Error removing {path}: {e}")
+
+    def _run(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.destination)), exist_ok=True)
+            size, ranges = self._probe()
+            if size and ranges and self.connections > 1:
+                self._download_segmented(size)
+            else:
+                self._download_single(size if ranges else 0)
+            self._verify()
+            if self._cancelled.is_set():
+                raise DownloadCancelled()
+            os.replace(self.part_path, self.destination)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+        except DownloadCancelled:
+            logging.info(f"Download of {self.url} cancelled")
+        except Exception as e:
+            logging.error(f"Error downloading {self.url}: {e}")
+            self.error = e
+        with self._lock:
+            self._finished = True
+            remove: bool = self._remove
+        if remove:
+            self.remove_partial()
+        self.on_done(self)
+
+    def _probe(self) -> Tuple[int, bool]:
+        """Return the size of the file and whether the server accepts Range requests."""
+        try:
+            response = requests.head(self.url, allow_redirects=True, timeout=self.timeout)
+            response.raise_for_status()
+            size = int(response.headers.get("Content-Length", 0))
+            return size, response.headers.get("Accept-Ranges", "none").lower() == "bytes"
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.warning(f"Could not get download info for {self.url}: {e}")
+            return 0, False
+
+    def _add_progress(self, amount: int, force: bool = False):
+        with self._lock:
+            self.downloaded += amount
+            now = time.monotonic()
+            if not force and now - self._last_progress < self.progress_interval:
+                return
+            self._last_progress = now
+        self.on_progress(self.downloaded, self.total)
+
+    def _stream(self, response: requests.Response, write: Callable[[bytes], Any]):
+        for data in response.iter_content(chunk_size=self.chunk_size):
+            if self._cancelled.is_set():
+                raise DownloadCancelled()
+            write(data)
+            self._add_progress(len(data))
+
+    def _download_single(self, size: int):
+        """Download with one connection, resuming the part file if the server supports it."""
+        offset = os.path.getsize(self.part_path) if size and os.path.exists(self.part_path) else 0
+        if offset > size:
+            offset = 0
+        if size and offset == size:
+            self.total = self.downloaded = size
+            return
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            self.total = offset + int(response.headers.get("Content-Length", 0)) if not size else size
+            self.downloaded = offset
+            with open(self.part_path, "ab" if offset else "wb") as f:
+                self._stream(response, f.write)
+        self._add_progress(0, True)
+
+    def _load_segments(self, size: int) -> List[List[int]]:
+        """Return the [start, end, done] segments to download, resuming the saved ones if they match."""
+        if os.path.exists(self.state_path) and os.path.exists(self.part_path):
+            try:
+                with open(self.state_path) as f:
+                    state: Dict = json.load(f)
+                if state.get("url") == self.url and state.get("size") == size:
+                    return state["segments"]
+            except (OSError, json.JSONDecodeError, KeyError) as e:
+                logging.warning(f"Ignoring download state {self.state_path}: {e}")
+        step = -(-size // self.connections)
+        return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+    def _save_segments(self, size: int, segments: List[List[int]]):
+        with self._lock:
+            data = json.dumps({"url": self.url, "size": size, "segments": segments})
+        with open(self.state_path, "w") as f:
+            f.write(data)
+
+    def _download_segment(self, fd: int, segment: List[int]):
+        start, end, done = segment
+        if start + done > end:
+            return
+        headers = {"Range": f"bytes={start + done}-{end}"}
+        with requests.get(self.url, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError(f"Server ignored range request for {self.url}")
+
+            def write(data: bytes):
+                os.pwrite(fd, data, segment[0] + segment[2])
+                with self._lock:
+                    segment[2] += len(data)
+
+            self._stream(response, write)
+
+    def _download_segmented(self, size: int):
+        """Download the file with several connections, each writing its own range of the part file."""
+        segments = self._load_segments(size)
+        self.total = size
+        self.downloaded = sum(segment[2] for segment in segments)
+        mode = "r+b" if os.path.exists(self.part_path) else "wb"
+        with open(self.part_path, mode) as f:
+            f.truncate(size)
+            errors: List[Exception] = []
+
+            def worker(segment: List[int]):
+                try:
+                    self._download_segment(f.fileno(), segment)
+                except Exception as e:
+                    errors.append(e)
+                    self._cancelled.set()
+
+            threads = [threading.Thread(target=worker, args=(segment,), daemon=True) for segment in segments]
+            for thread in threads:
+                thread.start()
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)
+                self._save_segments(size, segments)
+        self._add_progress(0, True)
+        real_errors = [e for e in errors if not isinstance(e, DownloadCancelled)]
+        if real_errors:
+            # Only the failure cancelled the other segments, the download itself was not cancelled
+            self._cancelled.clear()
+            raise real_errors[0]
+        if errors:
+            raise DownloadCancelled()
+
+    def _verify(self):
+        if self.checksum is None:
+            return
+        digest = hashlib.new(self.algorithm)
+        with open(self.part_path, "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                if self._cancelled.is_set():
+                    raise DownloadCancelled()
+                digest.update(data)
+        if digest.hexdigest() != self.checksum:
+            self.remove_partial()
+            raise ChecksumError(f"Checksum mismatch for {self.destination}: expected {self.checksum}, got {digest.hexdigest()}")
+
+
+class DownloadManager:
+    """Keeps track of the running downloads, one per destination file."""
+
+    def __init__(self):
+        self.downloads: Dict[str, Download] = {}
+        self._lock = threading.Lock()
+
+    def download(self, url: str, destination: str, **kwargs) -> Download:
+        """Start downloading url to destination, or return the download already running for it.
+
+        Keyword arguments are passed to Download: checksum, algorithm, connections, on_progress, on_done...
+        """
+        with self._lock:
+            running = self.downloads.get(destination)
+            if running is not None and running.thread.is_alive():
+                return running
+            download = Download(url, destination, **kwargs)
+            self.downloads[destination] = download
+        download.start()
+        return download
+
+    def get(self, destination: str) -> Download | None:
+        download = self.downloads.get(destination)
+        return download if download is not None and download.thread.is_alive() else None
+
+    def cancel(self, destination: str, remove: bool = False):
+        """Cancel the download to destination, if any, without waiting for it to stop."""
+        download = self.downloads.pop(destination, None)
+        if download is not None:
+            download.cancel(remove)
+
+
+download_manager = DownloadManager()
@@ -1,8 +1,9 @@
 from __future__ import absolute_import
-import importlib, subprocess
+import importlib, subprocess, json, hashlib, pickle, tempfile, threading
+from collections import OrderedDict, deque
 import re
 import os, sys
-import xml.dom.minidom, html
+import xml.parsers.expat, html
 import logging
 
 # Set up logging
@@ -38,29 +39,349 @@ def replace_variables(text: str, variables: dict) -> str:
         text = text.replace("{" + key + "}", str(value))
     return text
 
-def markwon_to_pango(markdown_text):
-    markdown_text = html.escape(markdown_text)
+MARKDOWN_PATTERNS = [
+    (re.compile(r'\*\*(.*?)\*\*'), r'<b>\1</b>'),
+    (re.compile(r'\*(.*?)\*'), r'<i>\1</i>'),
+    (re.compile(r'`(.*?)`'), r'<tt>\1</tt>'),
+    (re.compile(r'~(.*?)~'), r'<span strikethrough="true">\1</span>'),
+    (re.compile(r'\[(.*?)\]\((.*?)\)'), r'<a href="\2">\1</a>'),
+]
+HEADER_REGEX = re.compile(r'^(#{1,6}) (.*)$')
+HEADER_SIZES = ['xx-small', 'x-small', 'small', 'medium', 'large', 'x-large', 'xx-large']
+
+
+def is_valid_markup(markup: str) -> bool:
+    """Check that the markup is well formed, without building a DOM."""
+    parser = xml.parsers.expat.ParserCreate()
     try:
-        # Use a more concise approach with a dictionary for mapping
-        markdown_mappings = {
-            r'\*\*(.*?)\*\*': r'<b>\1</b>',
-            r'\*(.*?)\*': r'<i>\1</i>',
-            r'`(.*?)`': r'<tt>\1</tt>',
-            r'~(.*?)~': r'<span strikethrough="true">\1</span>',
-            r'\[(.*?)\]\((.*?)\)': r'<a href="\2">\1</a>',
-        }
-        for pattern, replacement in markdown_mappings.items():
-            markdown_text = re.sub(pattern, replacement, markdown_text)
-
-        # Handle headers separately
-        absolute_sizes = ['xx-small', 'x-small', 'small', 'medium', 'large', 'x-large', 'xx-large']
-        markdown_text = re.sub(r'^(#+) (.*)$', lambda match: f'<span font_weight="bold" font_size="{absolute_sizes[6 - len(match.group(1)) - 1]}">{match.group(2)}</span>', markdown_text, flags=re.MULTILINE)
-
-        xml.dom.minidom.parseString("<html>" + markdown_text + "</html>")
-        return markdown_text
-    except Exception as e:
-        logging.error(f"Error converting markdown: {e}")
-        return markdown_text
+        parser.Parse("<markup>" + markup + "</markup>", True)
+        return True
+    except xml.parsers.expat.ExpatError:
+        return False
+
+
+def markdown_line_to_pango(line: str) -> str:
+    """Convert one line, markdown elements never span more lines. Invalid results fall back to plain text."""
+    escaped = html.escape(line)
+    markup = escaped
+    for pattern, replacement in MARKDOWN_PATTERNS:
+        markup = pattern.sub(replacement, markup)
+    markup = HEADER_REGEX.sub(lambda match: f'<span font_weight="bold" font_size="{HEADER_SIZES[6 - len(match.group(1)) - 1]}">{match.group(2)}</span>', markup)
+    if markup != escaped and not is_valid_markup(markup):
+        logging.error(f"Error converting markdown: {line}")
+        return escaped
+    return markup
+
+
+def markwon_to_pango(markdown_text):
+    return "\n".join(markdown_line_to_pango(line) for line in markdown_text.split("\n"))
+
+
+class IncrementalPangoRenderer:
+    """Converts a streamed message to Pango markup, converting only the lines added since the previous update.
+
+    Completed lines are frozen, only the last line, that can still change, is converted again.
+    """
+
+    def __init__(self):
+        self.source: str = ""
+        self.markup: str = ""
+
+    def render(self, text: str) -> str:
+        if not text.startswith(self.source):
+            # The message was rewritten, start again
+            self.source, self.markup = "", ""
+        tail: str = text[len(self.source):]
+        end: int = tail.rfind("\n")
+        if end != -1:
+            for line in tail[:end].split("\n"):
+                self.markup += markdown_line_to_pango(line) + "\n"
+            self.source += tail[:end + 1]
+            tail = tail[end + 1:]
+        return self.markup + markdown_line_to_pango(tail)
+
+
+class ParseCache:
+    """LRU of parsed messages keyed by a hash of their content, so showing a chat again skips parsing.
+
+    When a path is given the cache can be saved and loaded with the chats. The version is stored with it,
+    and should be increased when the parsed format changes, to discard the old results.
+    """
+
+    def __init__(self, parse, version: int, max_entries: int = 2000, path: str | None = None):
+        self.parse = parse
+        self.version = version
+        self.max_entries = max_entries
+        self.path = path
+        self.entries: OrderedDict = OrderedDict()
+        self.changed: bool = False
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.sha1("\0".join(parts).encode()).hexdigest()
+
+    def get(self, *parts: str):
+        """Return parse(*parts), parsing only if the same content was not parsed before."""
+        key: str = self.key(*parts)
+        parsed = self.entries.get(key)
+        if parsed is not None:
+            self.entries.move_to_end(key)
+            return parsed
+        parsed = self.parse(*parts)
+        self.entries[key] = parsed
+        self.changed = True
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return parsed
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+            if data.get("version") == self.version:
+                self.entries = OrderedDict(data["entries"])
+        except Exception as e:
+            logging.error(f"Error loading parse cache: {e}")
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        try:
+            with open(self.path, "wb") as f:
+                pickle.dump({"version": self.version, "entries": list(self.entries.items())}, f)
+            self.changed = False
+        except OSError as e:
+            logging.error(f"Error saving parse cache: {e}")
+
+
+class OutputRingBuffer:
+    """Keeps the last max_chars characters of a command output, appended from any thread.
+
+    When the output gets longer, the full output is written to a temporary file instead of kept in memory.
+    The listeners are called after each append, from the thread that appended.
+    """
+
+    def __init__(self, max_chars: int = 65536):
+        self.max_chars = max_chars
+        self.chunks: deque = deque()
+        self.size: int = 0
+        self.dropped: int = 0
+        self.spill = None
+        self.spill_path: str | None = None
+        self.lock = threading.Lock()
+        self.listeners: list = []
+
+    def append(self, text: str):
+        if not text:
+            return
+        with self.lock:
+            if self.spill_path is None and self.size + len(text) > self.max_chars:
+                self._start_spill()
+            if self.spill is not None:
+                self.spill.write(text)
+            self.chunks.append(text)
+            self.size += len(text)
+            while self.size > self.max_chars:
+                excess: int = self.size - self.max_chars
+                if len(self.chunks[0]) <= excess:
+                    excess = len(self.chunks.popleft())
+                else:
+                    self.chunks[0] = self.chunks[0][excess:]
+                self.size -= excess
+                self.dropped += excess
+        for listener in list(self.listeners):
+            listener()
+
+    def _start_spill(self):
+        try:
+            self.spill = tempfile.NamedTemporaryFile("w", prefix="newelle-console-", suffix=".log", delete=False)
+            self.spill_path = self.spill.name
+            # Nothing was dropped yet, the chunks are the whole output so far
+            self.spill.write("".join(self.chunks))
+        except OSError as e:
+            logging.error(f"Error saving the console output: {e}")
+            self.spill, self.spill_path = None, ""
+
+    def close(self):
+        """Called when the command ended, to close the spill file."""
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill = None
+
+    def read_since(self, position: int) -> tuple:
+        """Return (text, end, replace): the output after position, or all the kept output with replace set
+        if part of what came after position was already dropped. end is the position to pass next time."""
+        with self.lock:
+            text: str = "".join(self.chunks)
+            end: int = self.dropped + self.size
+        if position < self.dropped:
+            return text, end, True
+        return text[position - self.dropped:], end, False
+
+    def text(self) -> str:
+        with self.lock:
+            text: str = "".join(self.chunks)
+        if self.spill_path:
+            return f"[Output truncated to the last {self.max_chars} characters, full output in {self.spill_path}]\n" + text
+        return text
+
+
+TOKEN_REGEX = re.compile(r"\w{1,4}|[^\w\s]")
+
+def estimate_tokens(text: str) -> int:
+    """Approximates the number of tokens of a text, for when the provider does not report it."""
+    return len(TOKEN_REGEX.findall(text))
+
+
+class StreamingStringArrayParser:
+    """Incrementally parses a JSON array of strings, returning each string as soon as it is closed.
+
+    Text before the array (like code fences or "Here are [3] ideas:") is skipped: an array is only
+    parsed if its first element is a string. Values that are not strings are ignored and a truncated
+    input just keeps the strings completed so far.
+    """
+
+    def __init__(self):
+        self.depth: int = 0
+        self.in_string: bool = False
+        self.escaped: bool = False
+        self.done: bool = False
+        # True between the opening bracket of a candidate array and its first element
+        self.first: bool = False
+        self.current: list = []
+
+    def feed(self, text: str) -> list:
+        """Parse the next piece of text, returning the strings of the top level array closed by it."""
+        completed: list = []
+        for char in text:
+            if self.done:
+                break
+            if self.first:
+                if char.isspace():
+                    continue
+                self.first = False
+                if char != '"':
+                    # Not an array of strings, look for the next one
+                    self.depth = 0
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        completed.append(self._decode("".join(self.current)))
+                    self.current = []
+                    continue
+                if self.depth == 1:
+                    self.current.append(char)
+            elif char == '"' and self.depth > 0:
+                self.in_string = True
+            elif char == "[" and self.depth == 0:
+                self.depth = 1
+                self.first = True
+            elif char in "[{" and self.depth > 0:
+                self.depth += 1
+            elif char in "]}" and self.depth > 0:
+                self.depth -= 1
+                self.done = self.depth == 0
+        return completed
+
+    @staticmethod
+    def _decode(raw: str) -> str:
+        try:
+            return json.loads('"' + raw + '"')
+        except json.JSONDecodeError:
+            return raw
+
+
+# Fenced blocks defined in the prompts that the window acts on
+BLOCK_TYPES = ("console", "file", "folder", "chart", "image")
+
+
+class StreamingBlockParser:
+    """Incrementally finds the fenced blocks of an answer, returning (type, content) as soon as a block closes.
+
+    Only the block types given are returned, the other code blocks are skipped.
+    """
+
+    def __init__(self, types: tuple = BLOCK_TYPES):
+        self.types = types
+        self.line: str = ""
+        self.block_type: str | None = None
+        self.block_lines: list = []
+
+    def feed(self, text: str) -> list:
+        """Parse the next piece of text, returning the blocks closed by it."""
+        completed: list = []
+        lines = (self.line + text).split("\n")
+        self.line = lines.pop()
+        for line in lines:
+            self._parse_line(line, completed)
+        return completed
+
+    def finish(self) -> list:
+        """Parse the last line, at the end of the answer, returning the block it closes if any."""
+        completed: list = []
+        if self.line:
+            self._parse_line(self.line, completed)
+            self.line = ""
+        return completed
+
+    def _parse_line(self, line: str, completed: list):
+        stripped = line.strip()
+        if self.block_type is None:
+            # Blocks can be opened after some text on the same line, like "Assistant: ```chart"
+            start = line.find("```")
+            if start != -1 and "```" not in line[start + 3:]:
+                self.block_type = line[start + 3:].strip()
+                self.block_lines = []
+        elif stripped == "```":
+            if self.block_type in self.types:
+                completed.append((self.block_type, "\n".join(self.block_lines)))
+            self.block_type = None
+        else:
+            self.block_lines.append(line)
+
+
+class DeltaFeeder:
+    """Feeds the text added by each streamed update to an incremental parser, passing what it returns to emit.
+
+    When the handler rewrites the message instead of extending it, the message is parsed again
+    from the start, skipping the results already emitted.
+    """
+
+    def __init__(self, factory, emit):
+        self.factory = factory
+        self.emit = emit
+        self.parser = factory()
+        self.received: str = ""
+        self.parsed: int = 0
+        self.skip: int = 0
+
+    def update(self, message: str, *args):
+        if not message.startswith(self.received):
+            self.parser, self.received, self.skip, self.parsed = self.factory(), "", self.parsed, 0
+        self._emit(self.parser.feed(message[len(self.received):]))
+        self.received = message
+
+    def close(self, message: str):
+        """Parse the final answer, and flush the parser if it supports it."""
+        if message.startswith(self.received):
+            self.update(message)
+        if hasattr(self.parser, "finish"):
+            self._emit(self.parser.finish())
+
+    def _emit(self, results: list):
+        self.parsed += len(results)
+        new_results = results[self.skip:]
+        self.skip = max(0, self.skip - len(results))
+        if new_results:
+            self.emit(new_results)
 
 
 def human_readable_size(size: float, decimal_places:int =2) -> str:
@@ -1,6 +1,7 @@
 import gi, os, subprocess
 from gi.repository import Gtk, Pango, Gio, Gdk, GtkSource, GObject, Adw, GLib
-import threading
+import threading, functools
+from .extra import IncrementalPangoRenderer, OutputRingBuffer
 import logging
 
 # Set up logging
@@ -16,34 +17,50 @@ def apply_css_to_widget(widget, css_string):
         logging.error(f"Error applying CSS: {e}")
 
 
+FOLDER_ICONS = {
+    "Desktop": "user-desktop",
+    "Documents": "folder-documents",
+    "Downloads": "folder-download",
+    "Music": "folder-music",
+    "Pictures": "folder-pictures",
+    "Public": "folder-publicshare",
+    "Templates": "folder-templates",
+    "Videos": "folder-videos",
+    ".var/app/io.github.qwersyk.Newelle/Newelle": "user-bookmarks",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def get_extension_icon_name(extension: str) -> str:
+    """Icon of the files with an extension, guessed once per extension"""
+    if extension in (".png", ".jpg"):
+        return "image-x-generic"
+    content_type, _uncertain = Gio.content_type_guess("file" + extension, None)
+    return Gio.content_type_get_generic_icon_name(content_type) or "text-x-generic"
+
+
+def get_file_icon_name(file_name: str, is_dir: bool) -> str:
+    if is_dir:
+        return FOLDER_ICONS.get(file_name, "folder")
+    return get_extension_icon_name(os.path.splitext(file_name)[1].lower())
+
+
 class File(Gtk.Image):
-    def __init__(self, path, file_name):
-        icon_name = self._get_icon_name(file_name)
-        super().__init__(icon_name=icon_name)
-        self.path = path
-        self.file_name = file_name
+    def __init__(self, path, file_name, is_dir=None):
+        super().__init__()
+        self.set_file(path, file_name, is_dir)
         self.drag_source = Gtk.DragSource.new()
         self.drag_source.set_actions(Gdk.DragAction.COPY)
         self.drag_source.connect("prepare", self.move)
         self.add_controller(self.drag_source)
 
-    def _get_icon_name(self, file_name):
-        if os.path.isdir(os.path.join(os.path.expanduser(self.path), file_name)):
-            # Use a dictionary for more efficient lookup
-            icon_map = {
-                "Desktop": "user-desktop",
-                "Documents": "folder-documents",
-                "Downloads": "folder-download",
-                "Music": "folder-music",
-                "Pictures": "folder-pictures",
-                "Public": "folder-publicshare",
-                "Templates": "folder-templates",
-                "Videos": "folder-videos",
-                ".var/app/io.github.qwersyk.Newelle/Newelle": "user-bookmarks",
-            }
-            return icon_map.get(file_name, "folder")
-        else:
-            return "image-x-generic" if file_name.lower().endswith(('.png', '.jpg')) else "text-x-generic"
+    def set_file(self, path, file_name, is_dir=None):
+        """Show another file, used when a tile of the explorer is recycled. is_dir avoids a stat when known"""
+        self.path = path
+        self.file_name = file_name
+        if is_dir is None:
+            is_dir = os.path.isdir(os.path.join(os.path.expanduser(path), file_name))
+        self.set_from_icon_name(get_file_icon_name(file_name, is_dir))
 
     def move(self, drag_source, x, y):
         snapshot = Gtk.Snapshot.new()
@@ -120,6 +137,17 @@ class MultilineEntry(Gtk.Box):
             self.on_change_func(self)
 
 
+@functools.lru_cache(maxsize=None)
+def get_language(lang: str) -> GtkSource.Language | None:
+    """Language lookup through the process wide manager, cached since every code block needs one"""
+    return GtkSource.LanguageManager.get_default().get_language(lang)
+
+
+@functools.lru_cache(maxsize=None)
+def get_style_scheme(name: str) -> GtkSource.StyleScheme | None:
+    return GtkSource.StyleSchemeManager.get_default().get_scheme(name)
+
+
 class CopyBox(Gtk.Box):
     def __init__(self, txt, lang, parent=None, id_message=-1):
         Gtk.Box.__init__(self, orientation=Gtk.Orientation.VERTICAL, spacing=10, margin_top=10, margin_start=10,
@@ -141,12 +169,10 @@ class CopyBox(Gtk.Box):
         self.sourceview = GtkSource.View()
         self.buffer = GtkSource.Buffer()
         self.buffer.set_text(self.txt, -1)
-        manager = GtkSource.LanguageManager.new()
-        language = manager.get_language(lang)
-        self.buffer.set_language(language)
-        style_scheme_manager = GtkSource.StyleSchemeManager.new()
-        style_scheme = style_scheme_manager.get_scheme('classic')
-        self.buffer.set_style_scheme(style_scheme)
+        self.buffer.set_style_scheme(get_style_scheme('classic'))
+        # Shown as plain text until the block is on screen
+        self.lang = lang
+        self.highlight_handler = self.sourceview.connect("map", self._on_map)
         self.sourceview.set_buffer(self.buffer)
         self.sourceview.set_vexpand(True)
         self.sourceview.set_show_line_numbers(True)
@@ -167,6 +193,13 @@ class CopyBox(Gtk.Box):
         elif lang == "console":
             self._add_console_buttons(box)
 
+    def _on_map(self, sourceview):
+        sourceview.disconnect(self.highlight_handler)
+        GLib.idle_add(self._highlight)
+
+    def _highlight(self):
+        self.buffer.set_language(get_language(self.lang))
+
     def _get_style_class(self, lang):
         style_map = {
             ("python", "cpp", "php", "objc", "go", "typescript", "lua", "perl", "r", "dart", "sql"): "accent",
@@ -210,12 +243,23 @@ class CopyBox(Gtk.Box):
         console = "None"
         if self.id_message < len(self.parent.chat) and self.parent.chat[self.id_message]["User"] == "Console":
             console = self.parent.chat[self.id_message]["Message"]
-        self.text_expander.set_child(Gtk.Label(wrap=True, wrap_mode=Pango.WrapMode.WORD_CHAR, label=console, selectable=True))
+        output = OutputRingBuffer()
+        output.append(console)
+        self.text_expander.set_child(ConsoleView(output))
         self.text_expander.set_expanded(False)
         box.append(self.run_button)
         box.append(self.terminal_button)
         self.append(self.text_expander)
 
+    def append_text(self, text):
+        """Append streamed code, the buffer highlights only the inserted region"""
+        self.txt += text
+        self.buffer.insert(self.buffer.get_end_iter(), text, -1)
+
+    def finish(self):
+        """Called when the streamed block is closed, the widget is kept as it is"""
+        self.txt = self.txt.rstrip("\n")
+
     def copy_button_clicked(self, widget):
         clipboard = Gdk.Display.get_default().get_clipboard()
         clipboard.set_content(Gdk.ContentProvider.new_for_value(self.txt))
@@ -229,12 +273,13 @@ class CopyBox(Gtk.Box):
             icon.set_icon_size(Gtk.IconSize.INHERIT)
             widget.set_child(icon)
             widget.set_sensitive(False)
-            code = self.parent.execute_terminal_command(self.txt.split("\n"))
+            output = OutputRingBuffer()
+            GLib.idle_add(self._show_console, output)
+            code = self.parent.execute_terminal_command(self.txt.split("\n"), output)
             if self.id_message < len(self.parent.chat) and self.parent.chat[self.id_message]["User"] == "Console":
                 self.parent.chat[self.id_message]["Message"] = code[1]
             else:
                 self.parent.chat.append({"User": "Console", "Message": " " + code[1]})
-            self.text_expander.set_child(Gtk.Label(wrap=True, wrap_mode=Pango.WrapMode.WORD_CHAR, label=code[1], selectable=True))
             if self.parent.status and len(self.parent.chat) - 1 == self.id_message and self.id_message < len(self.parent.chat) and self.parent.chat[self.id_message]["User"] == "Console":
                 self.parent.status = False
                 self.parent.update_button_text()
@@ -247,6 +292,11 @@ class CopyBox(Gtk.Box):
         else:
             threading.Thread(target=self.run_console, args=[widget, True]).start()
 
+    def _show_console(self, output):
+        self.text_expander.set_child(ConsoleView(output))
+        self.text_expander.set_expanded(True)
+        return False
+
     def run_console_terminal(self, widget, multithreading=False):
         icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name="emblem-ok-symbolic"))
         icon.set_icon_size(Gtk.IconSize.INHERIT)
@@ -275,6 +325,163 @@ class CopyBox(Gtk.Box):
         self.text_expander.set_child(Gtk.Label(wrap=True, wrap_mode=Pango.WrapMode.WORD_CHAR, label=text, selectable=True))
 
 
+class ConsoleView(Gtk.Box):
+    """Shows an OutputRingBuffer while the command writes to it.
+
+    Appends only queue an update, applied once per frame and only while the view is on screen,
+    and the text view never holds more than the characters kept by the buffer.
+    """
+
+    def __init__(self, output: OutputRingBuffer):
+        super().__init__(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        self.output = output
+        self.position = 0
+        self.update_queued = False
+        self.lock = threading.Lock()
+        self.spill_label = Gtk.Label(visible=False, wrap=True, wrap_mode=Pango.WrapMode.WORD_CHAR, selectable=True,
+                                     halign=Gtk.Align.START, css_classes=["dim-label", "caption"])
+        self.append(self.spill_label)
+        self.buffer = Gtk.TextBuffer()
+        self.end_mark = self.buffer.create_mark(None, self.buffer.get_end_iter(), False)
+        self.textview = Gtk.TextView(buffer=self.buffer, editable=False, cursor_visible=False, monospace=True,
+                                     wrap_mode=Gtk.WrapMode.WORD_CHAR)
+        self.append(Gtk.ScrolledWindow(child=self.textview, propagate_natural_height=True, max_content_height=300,
+                                       hscrollbar_policy=Gtk.PolicyType.NEVER))
+        # Listens only while realized, so that views scrolled out of the chat stop receiving updates
+        self.connect("realize", self._on_realize)
+        self.connect("unrealize", self._on_unrealize)
+
+    def _on_realize(self, widget):
+        self.output.listeners.append(self.queue_update)
+        self.queue_update()
+
+    def _on_unrealize(self, widget):
+        self.output.listeners.remove(self.queue_update)
+
+    def queue_update(self):
+        """Can be called from any thread"""
+        with self.lock:
+            if self.update_queued:
+                return
+            self.update_queued = True
+        GLib.idle_add(self._add_tick)
+
+    def _add_tick(self):
+        self.add_tick_callback(self._update)
+        return False
+
+    def _update(self, widget, frame_clock):
+        with self.lock:
+            self.update_queued = False
+        text, self.position, replace = self.output.read_since(self.position)
+        if replace:
+            self.buffer.set_text(text, -1)
+        else:
+            self.buffer.insert(self.buffer.get_end_iter(), text, -1)
+        excess = self.buffer.get_char_count() - self.output.max_chars
+        if excess > 0:
+            self.buffer.delete(self.buffer.get_start_iter(), self.buffer.get_iter_at_offset(excess))
+        if self.output.spill_path:
+            self.spill_label.set_label(_("Only the end of the output is shown, the full output is in ") + self.output.spill_path)
+            self.spill_label.set_visible(True)
+        self.textview.scroll_to_mark(self.end_mark, 0, False, 0, 0)
+        return GLib.SOURCE_REMOVE
+
+
+class StreamingMessageBox(Gtk.Box):
+    """Shows a message while it is streamed: text is rendered incrementally, code blocks become a CopyBox
+    as soon as their fence opens and the code is appended to it as it arrives, so nothing is rebuilt at the end."""
+
+    def __init__(self, parent=None, id_message=-1):
+        Gtk.Box.__init__(self, orientation=Gtk.Orientation.VERTICAL)
+        self.parent = parent
+        self.id_message = id_message
+        self._reset()
+
+    def _reset(self):
+        child = self.get_first_child()
+        while child is not None:
+            self.remove(child)
+            child = self.get_first_child()
+        self.received = ""
+        self.line = ""
+        self.text = ""
+        self.label = None
+        self.renderer = IncrementalPangoRenderer()
+        self.code = None
+        self.code_lines = 0
+        self.shown = 0
+
+    def update(self, message):
+        """Show the message streamed so far"""
+        if not message.startswith(self.received):
+            self._reset()
+        parts = message[len(self.received):].split("\n")
+        self.received = message
+        for i, part in enumerate(parts):
+            self.line += part
+            if i < len(parts) - 1:
+                self._end_line()
+        self._show_line()
+
+    def finish(self, message):
+        """Show the complete message, closing a code block left open"""
+        self.update(message)
+        if self.line:
+            self._end_line()
+        if self.code is not None:
+            self.code.finish()
+            self.code = None
+
+    def _end_line(self):
+        line, self.line = self.line, ""
+        if self.code is None:
+            if line.strip().startswith("```"):
+                # Remove the fence, shown as text while its line was incomplete
+                self._render_text()
+                self.code = CopyBox("", line.strip()[3:].strip() or "text", parent=self.parent, id_message=self.id_message)
+                self.code_lines, self.shown = 0, 0
+                self.append(self.code)
+                self.text, self.label = "", None
+            else:
+                self.text += line + "\n"
+                self._render_text()
+        elif line.strip() == "```":
+            self.code.finish()
+            self.code = None
+        else:
+            self._append_code(line[self.shown:], self.shown == 0)
+            self.shown = 0
+
+    def _show_line(self):
+        if self.code is None:
+            self._render_text()
+        elif not self.line.lstrip().startswith("`") and len(self.line) > self.shown:
+            # The line can not be the closing fence, show it before it is complete
+            self._append_code(self.line[self.shown:], self.shown == 0)
+            self.shown = len(self.line)
+
+    def _append_code(self, text, new_line):
+        if new_line:
+            if self.code_lines > 0:
+                text = "\n" + text
+            self.code_lines += 1
+        if text:
+            self.code.append_text(text)
+
+    def _render_text(self):
+        text = (self.text + self.line).rstrip("\n")
+        if not text.strip():
+            if self.label is not None:
+                self.label.set_markup("")
+            return
+        if self.label is None:
+            self.label = Gtk.Label(use_markup=True, wrap=True, wrap_mode=Pango.WrapMode.WORD_CHAR, selectable=True,
+                                   halign=Gtk.Align.START, xalign=0)
+            self.append(self.label)
+        self.label.set_markup(self.renderer.render(text))
+
+
 class BarChartBox(Gtk.Box):
     def __init__(self, data_dict, percentages):
         Gtk.Box.__init__(self, orientation=Gtk.Orientation.VERTICAL, margin_top=10, margin_start=10,
@@ -295,6 +502,77 @@ class BarChartBox(Gtk.Box):
             self.append(bar_box)
 
 
+class ChatMessage(GObject.Object):
+    """Item of the chat list model, pointing to a message of the chat"""
+
+    def __init__(self, index: int, message: dict):
+        super().__init__()
+        self.index = index
+        self.message = message
+
+
+class ChatView(Gtk.ListView):
+    """Virtualized chat: only the visible messages have widgets, built by build_row(index, message) when
+    a row is bound and dropped when it is recycled for another message."""
+
+    def __init__(self, build_row, **kwargs):
+        self.build_row = build_row
+        self.store = Gio.ListStore(item_type=ChatMessage)
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self._on_setup)
+        factory.connect("bind", self._on_bind)
+        factory.connect("unbind", self._on_unbind)
+        super().__init__(model=Gtk.NoSelection(model=self.store), factory=factory, **kwargs)
+
+    def _on_setup(self, factory, list_item):
+        list_item.set_activatable(False)
+        list_item.set_selectable(False)
+        list_item.set_child(Gtk.Box(orientation=Gtk.Orientation.VERTICAL))
+
+    def _on_bind(self, factory, list_item):
+        item = list_item.get_item()
+        widget = self.build_row(item.index, item.message)
+        if widget is not None:
+            list_item.get_child().append(widget)
+
+    def _on_unbind(self, factory, list_item):
+        box = list_item.get_child()
+        child = box.get_first_child()
+        while child is not None:
+            box.remove(child)
+            child = box.get_first_child()
+
+    def set_messages(self, messages: list):
+        """Show the messages, replacing the ones shown. Only the list model is rebuilt, not the widgets."""
+        self.store.splice(0, self.store.get_n_items(), [ChatMessage(i, message) for i, message in enumerate(messages)])
+
+    def append_message(self, message: dict):
+        self.store.append(ChatMessage(self.store.get_n_items(), message))
+
+    def update_message(self, index: int, message: dict):
+        """Rebuild the row of a message that changed, if it is visible"""
+        if index < self.store.get_n_items():
+            self.store.splice(index, 1, [ChatMessage(index, message)])
+
+
+class ExplorerItem(GObject.Object):
+    """Item of the explorer list model"""
+
+    def __init__(self, path: str, name: str, is_dir: bool):
+        super().__init__()
+        self.path = path
+        self.name = name
+        self.is_dir = is_dir
+
+
+class ChatHistoryItem(GObject.Object):
+    """Item of the history list model, pointing to a chat of the window"""
+
+    def __init__(self, chat: dict):
+        super().__init__()
+        self.chat = chat
+
+
 class ComboRowHelper(GObject.Object):
     __gsignals__ = {
         "changed": (GObject.SignalFlags.RUN_FIRST, None, (str,)),
@@ -0,0 +1,156 @@
+import os, signal, subprocess, threading, time, codecs
+from typing import Any, Callable, List
+from .extra import OutputRingBuffer
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class ConsoleJob:
+    """A console block run by the JobScheduler, with its timing, exit status and resource use.
+
+    poll and terminate behave like the ones of Popen, so jobs can be used where processes were.
+    """
+
+    def __init__(self, command: str, output: OutputRingBuffer, condition: threading.Condition):
+        self.command = command
+        self.output = output
+        self.condition = condition
+        self.state: str = QUEUED
+        self.queued_at: float = time.time()
+        self.started_at: float | None = None
+        self.ended_at: float | None = None
+        self.returncode: int | None = None
+        # Set when the job could not run its command, returncode is None then
+        self.error: str | None = None
+        self.cpu_time: float | None = None
+        self.max_rss: int | None = None
+        self.process: subprocess.Popen | None = None
+        # Stops the job when it does not run in its own process, like in a shell session
+        self.stop: Callable[[], Any] | None = None
+        self.cancelled: bool = False
+
+    def poll(self) -> int | None:
+        if self.state in (QUEUED, RUNNING):
+            return None
+        return self.returncode if self.returncode is not None else -signal.SIGTERM
+
+    def terminate(self):
+        if self.state not in (QUEUED, RUNNING):
+            return
+        with self.condition:
+            self.cancelled = True
+            # Wakes the job if it is still waiting for a slot
+            self.condition.notify_all()
+        if self.process is not None and self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        elif self.stop is not None:
+            self.stop()
+
+    def wait_time(self) -> float:
+        return (self.started_at or self.ended_at or time.time()) - self.queued_at
+
+    def run_time(self) -> float:
+        return (self.ended_at or time.time()) - self.started_at if self.started_at is not None else 0
+
+
+def run_process(job: ConsoleJob, arguments: List[str], cwd: str) -> int:
+    """Run a command streaming its output to the job output, recording its resource use with wait4."""
+    try:
+        # In its own process group, so that terminating the job also stops the commands it started
+        job.process = subprocess.Popen(arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd,
+                                       start_new_session=True)
+    except OSError as e:
+        logging.error(f"Error running command: {e}")
+        job.output.append(str(e))
+        return 127
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while chunk := os.read(job.process.stdout.fileno(), 65536):
+        job.output.append(decoder.decode(chunk))
+    job.output.append(decoder.decode(b"", final=True))
+    job.process.stdout.close()
+    _pid, status, rusage = os.wait4(job.process.pid, 0)
+    # Reaped by wait4, Popen must not wait for it again
+    job.process.returncode = os.waitstatus_to_exitcode(status)
+    job.cpu_time = rusage.ru_utime + rusage.ru_stime
+    job.max_rss = rusage.ru_maxrss
+    return job.process.returncode
+
+
+class JobScheduler:
+    """Runs console jobs concurrently up to max_jobs, the others wait in order for a free slot.
+
+    jobs keeps the queued, running and last finished jobs. listeners are called, from the thread of
+    the job, every time a job is added or changes state.
+    """
+
+    def __init__(self, max_jobs: int = 1, history: int = 50):
+        self.max_jobs = max_jobs
+        self.history = history
+        self.jobs: List[ConsoleJob] = []
+        self.running: int = 0
+        self.condition = threading.Condition()
+        self.listeners: List[Callable[[], Any]] = []
+
+    def set_max_jobs(self, max_jobs: int):
+        with self.condition:
+            self.max_jobs = max_jobs
+            self.condition.notify_all()
+
+    def submit(self, command: str, output: OutputRingBuffer) -> ConsoleJob:
+        """Add a job to the queue, it is started by run"""
+        job = ConsoleJob(command, output, self.condition)
+        with self.condition:
+            finished: List[ConsoleJob] = [j for j in self.jobs if j.state not in (QUEUED, RUNNING)]
+            for old in finished[:max(0, len(finished) - self.history + 1)]:
+                self.jobs.remove(old)
+            self.jobs.append(job)
+        self._changed()
+        return job
+
+    def run(self, job: ConsoleJob, target: Callable[[ConsoleJob], int]) -> ConsoleJob:
+        """Wait for a free slot, then run target in the calling thread, target returns the exit status."""
+        with self.condition:
+            # Jobs start in the order they were submitted
+            while not job.cancelled and (self.running >= self.max_jobs or self._first_queued() is not job):
+                self.condition.wait()
+            if job.cancelled:
+                job.state, job.ended_at = CANCELLED, time.time()
+                self.condition.notify_all()
+            else:
+                self.running += 1
+                job.state, job.started_at = RUNNING, time.time()
+        self._changed()
+        if job.state == CANCELLED:
+            return job
+        try:
+            job.returncode = target(job)
+        except Exception as e:
+            logging.error(f"Error running job: {e}")
+            job.error = str(e)
+            job.output.append(str(e))
+        finally:
+            with self.condition:
+                self.running -= 1
+                job.ended_at = time.time()
+                job.state = CANCELLED if job.cancelled else (DONE if job.returncode == 0 else FAILED)
+                self.condition.notify_all()
+            self._changed()
+        return job
+
+    def _first_queued(self) -> ConsoleJob | None:
+        return next((job for job in self.jobs if job.state == QUEUED and not job.cancelled), None)
+
+    def _changed(self):
+        for listener in list(self.listeners):
+            listener()
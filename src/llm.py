@@ -1,8 +1,9 @@
 from abc import abstractmethod
 from subprocess import PIPE, Popen, check_output
 import os, threading
-from typing import Callable, Any, Dict, List
-import time, json
+from typing import Callable, Any, Dict, List, Tuple
+import time, json, contextlib
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from g4f.Provider.selenium.Phind import quote
 from openai import NOT_GIVEN
@@ -10,8 +11,10 @@ import g4f
 from g4f.Provider import RetryProvider
 from gi.repository.Gtk import ResponseType
 
-from .extra import find_module, install_module, quote_string
+from .usage import UsageMeter, count_prompt_tokens
+from .extra import estimate_tokens, StreamingStringArrayParser, StreamingBlockParser, DeltaFeeder, find_module, install_module, quote_string
 from .handler import Handler
+from .scheduler import scheduler, as_rate_limit, RateLimited, RequestCancelled, FOREGROUND, AUXILIARY
 import requests
 from bs4 import BeautifulSoup
 import logging
@@ -19,16 +22,29 @@ import logging
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Models are loaded one at a time so that a reload never keeps two of them in memory while loading
+model_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-loader")
+
 
 class LLMHandler(Handler):
     """Every LLM model handler should extend this class."""
     history: List[Dict] = []
     prompts: List[str] = []
     schema_key: str = "llm-settings"
+    # Requests allowed per minute for each API key, 0 for handlers that are not rate limited
+    requests_per_minute: float = 60
 
     def __init__(self, settings: object, path: str):
         super().__init__(settings, path)
         self.web_search_enabled = self.get_setting("web_search_enabled") or False
+        self.loading: Future | None = None
+        self.recorder = None
+        self.usage_tracker = None
+        # Usage of the last call measured by the usage tracker, to be stored with the message
+        self.last_usage: Dict | None = None
+        self.provider_usage = threading.local()
+        # Usage of the last call measured in the calling thread, for callers running calls concurrently
+        self.thread_usage = threading.local()
 
     def stream_enabled(self) -> bool:
         """Return if the LLM supports token streaming"""
@@ -39,11 +55,88 @@ class LLMHandler(Handler):
         """Load the specified model."""
         return True
 
+    def load_model_async(self, model: str) -> Future:
+        """Load the specified model in background, returns the future of the load already running if any."""
+        if self.loading is None:
+            self.loading = model_loader.submit(self.load_model, model)
+        return self.loading
+
+    def wait_model_loaded(self):
+        """Block until a background model load started with load_model_async is done."""
+        if self.loading is not None:
+            try:
+                self.loading.result()
+            except Exception as e:
+                logging.error(f"Error loading model: {e}")
+
     def set_history(self, prompts: List[str], window: object):
         """Set the current history and prompts."""
         self.prompts = prompts
         self.history = window.chat[len(window.chat) - window.memory:len(window.chat) - 1]
 
+    def get_model_name(self) -> str:
+        """Name of the model used, for usage reports"""
+        return self.get_setting("model") or ""
+
+    def report_usage(self, prompt_tokens: int, completion_tokens: int):
+        """Called by handlers with the token counts reported by the provider, instead of estimating them."""
+        self.provider_usage.value = (prompt_tokens, completion_tokens)
+
+    def measure(self, kind: str, window: object, prompt: str, history: List[Dict], system_prompt: List[str],
+                generate: Callable[[Callable[..., Any]], str], on_update: Callable[..., Any] = lambda *_: None,
+                chat: Dict | None = None) -> str:
+        """Run generate(on_update) recording its tokens and latency in the usage tracker, if any.
+
+        generate returns an answer or a list of alternative answers. The call is counted for chat, by default
+        the current chat of window.
+        """
+        if kind in ("message", "candidates"):
+            self.last_usage = None
+        if self.usage_tracker is None:
+            return generate(on_update)
+        self.provider_usage.value = None
+        meter = UsageMeter()
+        answer: str | List[str] = generate(meter.wrap(on_update))
+        text: str = answer if isinstance(answer, str) else "".join(answer)
+        if self.provider_usage.value is not None:
+            prompt_tokens, completion_tokens = self.provider_usage.value
+        else:
+            prompt_tokens, completion_tokens = count_prompt_tokens(prompt, history, system_prompt), estimate_tokens(text)
+        usage: Dict[str, Any] = meter.finish(prompt_tokens, completion_tokens)
+        usage.update(handler=self.key, model=self.get_model_name(), kind=kind,
+                     estimated=self.provider_usage.value is None, error=text.startswith("Error"))
+        if chat is None and window is not None:
+            chat = window.chats[min(window.chat_id, len(window.chats) - 1)]
+        if chat is not None:
+            # Names are not unique and can change, the totals are grouped by the id of the chat
+            usage.update(chat=chat["id"], chat_name=chat["name"])
+        if window is not None:
+            usage["message"] = len(window.chat)
+        if kind in ("message", "candidates"):
+            self.last_usage = usage
+        self.thread_usage.value = usage
+        self.usage_tracker.record(usage)
+        return answer
+
+    def raise_if_rate_limited(self, error: Exception):
+        """Errors are returned as message text, except rate limits that are raised so that the request is retried."""
+        rate_limit = as_rate_limit(error)
+        if rate_limit is not None:
+            raise rate_limit from error
+
+    def schedule(self, func: Callable, *args, priority: int = FOREGROUND) -> Any:
+        """Run a request to the provider through the rate limiter, retrying it if it gets rate limited.
+
+        AUXILIARY requests wait until no message is being generated and raise RequestCancelled
+        if the user sends a new message before they start.
+        """
+        key = (self.key, str(self.get_setting("api") or self.get_setting("apikey") or ""))
+        try:
+            return scheduler.run(key, self.requests_per_minute, func, *args, priority=priority)
+        except RateLimited as e:
+            logging.error(f"Rate limited by {self.key}: {e}")
+            return f"Error: {e}"
+
     def get_default_setting(self, key: str) -> Any:
         """Get the default setting from a certain key."""
         extra_settings = self.get_extra_settings()
@@ -58,51 +151,184 @@ class LLMHandler(Handler):
     @abstractmethod
     def generate_text_stream(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = [],
                              on_update: Callable[[str], Any] = lambda _: None, extra_args: List = []) -> str:
-        """Generate text stream from the given prompt, history, and system prompt."""
+        """Generate text stream from the given prompt, history, and system prompt.
+
+        The generation stops early, keeping the text so far, when on_update returns False.
+        """
         pass
 
     def send_message(self, window: object, message: str) -> str:
         """Send a message to the bot."""
-        if self.web_search_enabled:
-            web_search_result = self.perform_web_search(message)
-            if web_search_result:
-                message = message + "\n\nWeb Search Results:\n" + web_search_result
-        return self.generate_text(message, self.history, self.prompts)
+        with scheduler.foreground():
+            self.wait_model_loaded()
+            message = self.augment_message(window, message)
+            return self.schedule(self.measure, "message", window, message, self.history, self.prompts,
+                                 lambda _: self.generate_text(message, self.history, self.prompts))
 
     def send_message_stream(self, window: object, message: str, on_update: Callable[[str], Any] = lambda _: None,
-                            extra_args: List = []) -> str:
-        """Send a message to the bot using streaming."""
-        if self.web_search_enabled:
-            web_search_result = self.perform_web_search(message)
-            if web_search_result:
-                message = message + "\n\nWeb Search Results:\n" + web_search_result
-        return self.generate_text_stream(message, self.history, self.prompts, on_update, extra_args)
-
-    def get_suggestions(self, request_prompt: str = "", amount: int = 1) -> List[str]:
-        """Get suggestions for the current chat."""
+                            extra_args: List = [], on_block: Callable[[str, str], Any] | None = None) -> str:
+        """Send a message to the bot using streaming.
+
+        on_block is called with the type and content of every console, file, folder, chart and image block
+        as soon as it is closed, while the rest of the answer is still being generated.
+        """
+        feeder: DeltaFeeder | None = None
+        if on_block is not None:
+            def emit_blocks(blocks: List[Tuple[str, str]]):
+                for block_type, content in blocks:
+                    on_block(block_type, content)
+
+            feeder = DeltaFeeder(StreamingBlockParser, emit_blocks)
+            forward = on_update
+
+            def on_update(message: str, *args):
+                feeder.update(message)
+                return forward(message, *args)
+
+        with scheduler.foreground():
+            self.wait_model_loaded()
+            message = self.augment_message(window, message)
+
+            def generate(update: Callable[..., Any]) -> str:
+                return self.generate_text_stream(message, self.history, self.prompts, update, extra_args)
+
+            if self.recorder is not None:
+                answer: str = self.schedule(self.measure, "message", window, message, self.history, self.prompts,
+                                            lambda update: self.recorder.record(self, message, update, generate),
+                                            on_update)
+            else:
+                answer = self.schedule(self.measure, "message", window, message, self.history, self.prompts,
+                                       generate, on_update)
+        if feeder is not None:
+            feeder.close(answer)
+        return answer
+
+    def send_message_candidates(self, window: object, message: str, on_update: Callable[[str], Any] = lambda _: None,
+                                on_candidate: Callable[[int, str], Any] | None = None) -> List[str]:
+        """Send a message to the bot, getting get_candidates_number() alternative answers.
+
+        With streaming enabled the first answer is streamed to on_update, on_candidate is called with the index
+        and text of every answer as soon as it is complete.
+        """
+        with scheduler.foreground():
+            self.wait_model_loaded()
+            message = self.augment_message(window, message)
+            return self.schedule(self.measure, "candidates", window, message, self.history, self.prompts,
+                                 lambda update: self.generate_candidates(message, self.history, self.prompts,
+                                                                         self.get_candidates_number(), update,
+                                                                         on_candidate),
+                                 on_update)
+
+    def get_candidates_number(self) -> int:
+        """Number of answers generated when regenerating a message"""
+        return int(self.get_setting("candidates") or 1)
+
+    def generate_candidates(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = [], n: int = 1,
+                            on_update: Callable[[str], Any] = lambda _: None,
+                            on_candidate: Callable[[int, str], Any] | None = None) -> List[str]:
+        """Generate n alternative answers, see send_message_candidates for the callbacks.
+
+        Handlers supporting it should override this to process the prompt once. The generation stops,
+        keeping the answers so far, when on_update returns False.
+        """
+        candidates: List[str] = []
+        stopped: bool = False
+
+        def update(*args):
+            nonlocal stopped
+            if on_update(*args) is False:
+                stopped = True
+                return False
+
+        for i in range(n):
+            if i == 0 and self.stream_enabled():
+                candidate: str = self.generate_text_stream(prompt, history, system_prompt, update)
+            else:
+                candidate = self.generate_text(prompt, history, system_prompt)
+            candidates.append(candidate)
+            if on_candidate is not None:
+                on_candidate(i, candidate)
+            if stopped:
+                break
+        return candidates
+
+    def get_suggestions(self, request_prompt: str = "", amount: int = 1,
+                        on_suggestion: Callable[[str], Any] | None = None, chat: Dict | None = None) -> List[str]:
+        """Get suggestions for the current chat.
+
+        The answer is streamed and parsed incrementally: on_suggestion is called with every suggestion
+        as soon as it is complete, and a truncated or malformed answer keeps the suggestions parsed so far.
+        chat is the chat the usage is counted for.
+        """
+        self.wait_model_loaded()
+        generation: int = scheduler.generation
         result: List[str] = []
         history: str = ""
         for message in self.history[-4:] if len(self.history) >= 4 else self.history:
             history += message["User"] + ": " + message["Message"] + "\n"
+
+        def add_suggestions(suggestions: List[str]):
+            for suggestion in suggestions:
+                if len(result) >= amount:
+                    return
+                if suggestion in result:
+                    continue
+                result.append(suggestion)
+                if on_suggestion is not None:
+                    on_suggestion(suggestion)
+
         for i in range(0, amount):
-            generated = self.generate_text(history + "\n\n" + request_prompt)
-            generated = generated.replace("```json", "").replace("```", "")
+            feeder = DeltaFeeder(StreamingStringArrayParser, add_suggestions)
+
+            def on_update(*args):
+                # A message sent meanwhile stops the generation, the suggestions are for the previous one
+                if scheduler.superseded(generation):
+                    return False
+                feeder.update(*args)
+
             try:
-                j = json.loads(generated)
-                if isinstance(j, list):
-                    for suggestion in j:
-                        if isinstance(suggestion, str):
-                            result.append(suggestion)
-                            i += 1
-                            if i >= amount:
-                                break
-            except json.JSONDecodeError as e:
-                logging.error(f"Error decoding JSON response: {e}")
+                prompt: str = history + "\n\n" + request_prompt
+                generated: str = self.schedule(self.measure, "suggestions", None, prompt, [], [],
+                                               lambda update: self.generate_text_stream(prompt, [], [], update),
+                                               on_update, chat, priority=AUXILIARY)
+            except RequestCancelled:
+                break
+            if scheduler.superseded(generation):
+                break
+            feeder.close(generated)
+            if len(result) >= amount:
+                break
         return result
 
-    def generate_chat_name(self, request_prompt: str = "") -> str:
-        """Generate name of the current chat."""
-        return self.generate_text(request_prompt, self.history)
+    def generate_chat_name(self, request_prompt: str = "", chat: Dict | None = None) -> str:
+        """Generate name of the current chat, chat is the chat the usage is counted for."""
+        self.wait_model_loaded()
+        generation: int = scheduler.generation
+        try:
+            name: str = self.schedule(self.measure, "chat_name", None, request_prompt, self.history, [],
+                                      lambda _: self.generate_text(request_prompt, self.history), lambda *_: None,
+                                      chat, priority=AUXILIARY)
+        except RequestCancelled:
+            return ""
+        # Handlers that can stop a running generation return what they had when a message was sent
+        return "" if scheduler.superseded(generation) else name
+
+    def augment_message(self, window: object, message: str) -> str:
+        """Add the past messages recalled by the semantic memory and the web search results to the message."""
+        memory = getattr(window, "semantic_memory", None)
+        if memory is not None:
+            try:
+                recalled: str = memory.recall(message, window.chats, self.history)
+            except Exception as e:
+                logging.error(f"Error recalling messages: {e}")
+                recalled = ""
+            if recalled:
+                message = message + "\n\nRelevant messages from previous chats:\n" + recalled
+        if self.web_search_enabled:
+            web_search_result = self.perform_web_search(message)
+            if web_search_result:
+                message = message + "\n\nWeb Search Results:\n" + web_search_result
+        return message
 
     def perform_web_search(self, query: str) -> str:
         """Perform a web search using Google."""
@@ -184,6 +410,7 @@ class G4FHandler(LLMHandler):
             )
             return response.choices[0].message.content
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text: {e}")
             return f"Error: {e}"
 
@@ -207,10 +434,12 @@ class G4FHandler(LLMHandler):
                     full_message += chunk.choices[0].delta.content
                     args = (full_message.strip(),) + tuple(extra_args)
                     if len(full_message) - len(prev_message) > 1:
-                        on_update(*args)
+                        if on_update(*args) is False:
+                            break
                         prev_message = full_message
             return full_message.strip()
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text stream: {e}")
             return f"Error: {e}"
 
@@ -291,6 +520,7 @@ class GPT3AnyHandler(G4FHandler):
             )
             return response.choices[0].message.content
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text: {e}")
             return f"Error: {e}"
 
@@ -313,19 +543,25 @@ class GPT3AnyHandler(G4FHandler):
                     full_message += chunk.choices[0].delta.content
                     args = (full_message.strip(),) + tuple(extra_args)
                     if len(full_message) - len(prev_message) > 1:
-                        on_update(*args)
+                        if on_update(*args) is False:
+                            break
                         prev_message = full_message
             return full_message.strip()
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text stream: {e}")
             return f"Error: {e}"
 
-    def generate_chat_name(self, request_prompt: str = "") -> str:
+    def generate_chat_name(self, request_prompt: str = "", chat: Dict | None = None) -> str:
         history: str = ""
         for message in self.history[-4:] if len(self.history) >= 4 else self.history:
             history += message["User"] + ": " + message["Message"] + "\n"
-        name: str = self.generate_text(history + "\n\n" + request_prompt)
-        return name
+        prompt: str = history + "\n\n" + request_prompt
+        try:
+            return self.schedule(self.measure, "chat_name", None, prompt, [], [],
+                                 lambda _: self.generate_text(prompt), lambda *_: None, chat, priority=AUXILIARY)
+        except RequestCancelled:
+            return ""
 
 
 class GeminiHandler(LLMHandler):
@@ -404,6 +640,7 @@ class GeminiHandler(LLMHandler):
             response = chat.send_message(prompt)
             return response.text
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text with Gemini: {e}")
             return "Message blocked: " + str(e)
 
@@ -430,15 +667,18 @@ class GeminiHandler(LLMHandler):
             for chunk in response:
                 full_message += chunk.text
                 args = (full_message.strip(),) + tuple(extra_args)
-                on_update(*args)
+                if on_update(*args) is False:
+                    break
             return full_message.strip()
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text stream with Gemini: {e}")
             return "Message blocked: " + str(e)
 
 
 class CustomLLMHandler(LLMHandler):
     key: str = "custom_command"
+    requests_per_minute: float = 0
 
     @staticmethod
     def requires_sandbox_escape() -> bool:
@@ -495,7 +735,8 @@ class CustomLLMHandler(LLMHandler):
             logging.error(f"Error executing custom command: {e}")
             return f"Error: {e}"
 
-    def get_suggestions(self, request_prompt: str = "", amount: int = 1) -> List[str]:
+    def get_suggestions(self, request_prompt: str = "", amount: int = 1,
+                        on_suggestion: Callable[[str], Any] | None = None, chat: Dict | None = None) -> List[str]:
         command: str = self.get_setting("suggestion")
         if not command:
             return []
@@ -504,10 +745,14 @@ class CustomLLMHandler(LLMHandler):
         command = command.replace("{2}", str(amount))
         try:
             out = check_output(["flatpak-spawn", "--host", "bash", "-c", command], text=True)
-            return json.loads(out.strip())
+            suggestions: List[str] = json.loads(out.strip())
         except Exception as e:
             logging.error(f"Error getting suggestions from custom command: {e}")
             return []
+        if on_suggestion is not None:
+            for suggestion in suggestions:
+                on_suggestion(suggestion)
+        return suggestions
 
     def generate_text_stream(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = [],
                              on_update: Callable[[str], Any] = lambda _: None, extra_args: List = []) -> str:
@@ -525,7 +770,9 @@ class CustomLLMHandler(LLMHandler):
                 full_message += chunk
                 args = (full_message.strip(),) + tuple(extra_args)
                 if len(full_message) - len(prev_message) > 1:
-                    on_update(*args)
+                    if on_update(*args) is False:
+                        process.terminate()
+                        break
                     prev_message = full_message
             process.wait()
             return full_message.strip()
@@ -597,8 +844,11 @@ class OllamaHandler(LLMHandler):
                 model=self.get_setting("model"),
                 messages=messages,
             )
+            if response.get("eval_count") is not None:
+                self.report_usage(response.get("prompt_eval_count") or 0, response["eval_count"])
             return response["message"]["content"]
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text with Ollama: {e}")
             return str(e)
 
@@ -619,13 +869,17 @@ class OllamaHandler(LLMHandler):
             full_message: str = ""
             prev_message: str = ""
             for chunk in response:
+                if chunk.get("done") and chunk.get("eval_count") is not None:
+                    self.report_usage(chunk.get("prompt_eval_count") or 0, chunk["eval_count"])
                 full_message += chunk["message"]["content"]
                 args = (full_message.strip(),) + tuple(extra_args)
                 if len(full_message) - len(prev_message) > 1:
-                    on_update(*args)
+                    if on_update(*args) is False:
+                        break
                     prev_message = full_message
             return full_message.strip()
         except Exception as e:
+            self.raise_if_rate_limited(e)
             logging.error(f"Error generating text stream with Ollama: {e}")
             return str(e)
 
@@ -667,6 +921,17 @@ class OpenAIHandler(LLMHandler):
                 "type": "toggle",
                 "default": True
             },
+            {
+                "key": "candidates",
+                "title": _("Regenerated answers"),
+                "description": _("Number of answers generated in a single request when regenerating a message, "
+                                 "each one is billed as a separate completion"),
+                "type": "range",
+                "min": 1,
+                "max": 5,
+                "default": 1,
+                "round-digits": 0
+            },
             {
                 "key": "advanced_params",
                 "title": _("Advanced Parameters"),
@@ -751,7 +1016,376 @@ class OpenAIHandler(LLMHandler):
             })
         return result
 
+    def get_client(self):
+        import openai
+        # The scheduler retries rate limited requests, the client must not retry them too
+        return openai.OpenAI(api_key=self.get_setting("api"), base_url=self.get_setting("endpoint"), max_retries=0)
+
     def generate_text(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = []) -> str:
         import openai
         openai.api_key = self.get_setting("api")
-        messages: List[Dict] = self.convert_
+        messages: List[Dict] = self.convert_history(history, system_prompt)
+        messages.append({"role": "user", "content": prompt})
+        client = self.get_client()
+        try:
+            response = client.chat.completions.create(
+                model=self.get_setting("model"),
+                messages=messages,
+                **self.get_advanced_params()
+            )
+            if response.usage is not None:
+                self.report_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+            return response.choices[0].message.content
+        except Exception as e:
+            self.raise_if_rate_limited(e)
+            logging.error(f"Error generating text with OpenAI: {e}")
+            return f"Error: {e}"
+
+    def generate_text_stream(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = [],
+                             on_update: Callable[[str], Any] = lambda _: None, extra_args: List = []) -> str:
+        messages: List[Dict] = self.convert_history(history, system_prompt)
+        messages.append({"role": "user", "content": prompt})
+        client = self.get_client()
+        try:
+            response = client.chat.completions.create(
+                model=self.get_setting("model"),
+                messages=messages,
+                stream=True,
+                # The usage is sent in a last chunk without choices
+                stream_options={"include_usage": True},
+                **self.get_advanced_params()
+            )
+            full_message: str = ""
+            prev_message: str = ""
+            for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    self.report_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    full_message += chunk.choices[0].delta.content
+                    args = (full_message.strip(),) + tuple(extra_args)
+                    if len(full_message) - len(prev_message) > 1:
+                        if on_update(*args) is False:
+                            break
+                        prev_message = full_message
+            return full_message.strip()
+        except Exception as e:
+            self.raise_if_rate_limited(e)
+            logging.error(f"Error generating text stream with OpenAI: {e}")
+            return f"Error: {e}"
+
+    def generate_candidates(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = [], n: int = 1,
+                            on_update: Callable[[str], Any] = lambda _: None,
+                            on_candidate: Callable[[int, str], Any] | None = None) -> List[str]:
+        messages: List[Dict] = self.convert_history(history, system_prompt)
+        messages.append({"role": "user", "content": prompt})
+        client = self.get_client()
+        try:
+            # n samples share the same prompt processing on the provider side
+            if not self.stream_enabled():
+                response = client.chat.completions.create(
+                    model=self.get_setting("model"),
+                    messages=messages,
+                    n=n,
+                    **self.get_advanced_params()
+                )
+                if response.usage is not None:
+                    self.report_usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+                candidates: List[str] = [choice.message.content or "" for choice in response.choices]
+                if on_candidate is not None:
+                    for i, candidate in enumerate(candidates):
+                        on_candidate(i, candidate)
+                return [candidate for candidate in candidates if candidate]
+            response = client.chat.completions.create(
+                model=self.get_setting("model"),
+                messages=messages,
+                n=n,
+                stream=True,
+                stream_options={"include_usage": True},
+                **self.get_advanced_params()
+            )
+            # The choices are interleaved in the chunks, the first one is streamed
+            texts: Dict[int, str] = {}
+            prev_message: str = ""
+            stopped: bool = False
+            for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    self.report_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                for choice in chunk.choices:
+                    texts[choice.index] = texts.get(choice.index, "") + (choice.delta.content or "")
+                    if choice.finish_reason is not None and on_candidate is not None:
+                        on_candidate(choice.index, texts[choice.index].strip())
+                    if choice.index == 0 and len(texts[0]) - len(prev_message) > 1:
+                        stopped = on_update(texts[0].strip()) is False
+                        prev_message = texts[0]
+                if stopped:
+                    response.close()
+                    break
+            return [texts[i].strip() for i in sorted(texts) if texts[i].strip()]
+        except Exception as e:
+            self.raise_if_rate_limited(e)
+            logging.error(f"Error generating candidates with OpenAI: {e}")
+            return [f"Error: {e}"]
+
+    def get_advanced_params(self) -> Dict[str, Any]:
+        """Sampling parameters for the request, NOT_GIVEN when advanced parameters are disabled."""
+        if not self.get_setting("advanced_params"):
+            return {"max_tokens": NOT_GIVEN, "top_p": NOT_GIVEN, "temperature": NOT_GIVEN,
+                    "frequency_penalty": NOT_GIVEN, "presence_penalty": NOT_GIVEN}
+        return {
+            "max_tokens": int(self.get_setting("max-tokens")),
+            "top_p": self.get_setting("top-p"),
+            "temperature": self.get_setting("temperature"),
+            "frequency_penalty": self.get_setting("frequency-penalty"),
+            "presence_penalty": self.get_setting("presence-penalty"),
+        }
+
+
+class GPT4AllHandler(LLMHandler):
+    """Local models run through GPT4All, keeping one evaluated chat session alive between turns"""
+    key: str = "local"
+    requests_per_minute: float = 0
+
+    def __init__(self, settings: object, modelspath: str):
+        super().__init__(settings, modelspath)
+        self.modelspath: str = modelspath
+        self.model_folder: str = os.path.join(self.modelspath, "custom_models")
+        if not os.path.isdir(self.model_folder):
+            os.makedirs(self.model_folder)
+        self.model = None
+        self.model_name: str = ""
+        self.lock = threading.Lock()
+        self.session = None
+        self.session_system_prompt: str | None = None
+        self.session_messages: List[Dict] = []
+        # Generation of the scheduler while generating suggestions and chat names, that must not change the session
+        self.auxiliary = threading.local()
+        # The last augmented prompt with the message it was made from, the session stores the message
+        self.augmented = threading.local()
+
+    @staticmethod
+    def get_extra_requirements() -> List[str]:
+        return ["gpt4all"]
+
+    def get_extra_settings(self) -> List[Dict]:
+        return [
+            {
+                "key": "streaming",
+                "title": _("Message Streaming"),
+                "description": _("Gradually stream message output"),
+                "type": "toggle",
+                "default": True
+            },
+            {
+                "key": "custom_model",
+                "title": _("Custom gguf model file"),
+                "description": _("Add a gguf file in the specified folder and then close and re-open the settings to update"),
+                "type": "combo",
+                "default": "",
+                "values": self.get_custom_model_list(),
+                "folder": os.path.abspath(self.model_folder),
+            },
+            {
+                "key": "threads",
+                "title": _("CPU Threads"),
+                "description": _("Number of CPU threads used for inference, 0 to choose automatically"),
+                "type": "range",
+                "min": 0,
+                "max": os.cpu_count() or 1,
+                "default": 0,
+                "round-digits": 0
+            },
+            {
+                "key": "n_ctx",
+                "title": _("Context size"),
+                "description": _("Maximum number of tokens kept in the model context, larger values keep longer chats evaluated"),
+                "type": "range",
+                "min": 512,
+                "max": 16384,
+                "default": 2048,
+                "round-digits": 0
+            },
+            {
+                "key": "n_batch",
+                "title": _("Batch size"),
+                "description": _("Number of prompt tokens evaluated in parallel, larger values prefill faster but use more memory"),
+                "type": "range",
+                "min": 1,
+                "max": 512,
+                "default": 128,
+                "round-digits": 0
+            },
+        ]
+
+    def get_custom_model_list(self) -> Tuple[Tuple[str, str]]:
+        file_list = tuple()
+        for root, _dirs, files in os.walk(self.model_folder):
+            for file in files:
+                if file.endswith(".gguf"):
+                    relative_path = os.path.relpath(os.path.join(root, file), self.model_folder)
+                    file_list += ((file[:-len(".gguf")], relative_path),)
+        return file_list
+
+    def model_available(self, model: str) -> bool:
+        return os.path.exists(os.path.join(self.modelspath, model))
+
+    def load_model(self, model: str) -> bool:
+        from gpt4all import GPT4All
+        if model == "custom":
+            model = self.get_setting("custom_model")
+            path = self.model_folder
+        else:
+            path = self.modelspath
+        if not model or not os.path.exists(os.path.join(path, model)):
+            return False
+        threads = int(self.get_setting("threads"))
+        with self.lock:
+            self.close_session()
+            try:
+                self.model = GPT4All(model, model_path=path, allow_download=False, device="cpu",
+                                     n_threads=threads if threads > 0 else None, n_ctx=int(self.get_setting("n_ctx")))
+                self.model_name = model
+            except Exception as e:
+                logging.error(f"Error loading local model {model}: {e}")
+                self.model = None
+                return False
+        return True
+
+    def get_model_name(self) -> str:
+        return self.model_name
+
+    def download_model(self, model: str) -> bool:
+        from gpt4all import GPT4All
+        GPT4All.retrieve_model(model, model_path=self.modelspath, allow_download=True, verbose=False)
+        return True
+
+    def close_session(self):
+        """Leave the current chat session, dropping the evaluated context."""
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+        self.session_system_prompt = None
+        self.session_messages = []
+
+    def augment_message(self, window: object, message: str) -> str:
+        augmented: str = super().augment_message(window, message)
+        self.augmented.value = (augmented, message)
+        return augmented
+
+    def get_suggestions(self, request_prompt: str = "", amount: int = 1,
+                        on_suggestion: Callable[[str], Any] | None = None, chat: Dict | None = None) -> List[str]:
+        self.auxiliary.value = scheduler.generation
+        try:
+            return super().get_suggestions(request_prompt, amount, on_suggestion, chat)
+        finally:
+            self.auxiliary.value = None
+
+    def generate_chat_name(self, request_prompt: str = "", chat: Dict | None = None) -> str:
+        self.auxiliary.value = scheduler.generation
+        try:
+            return super().generate_chat_name(request_prompt, chat)
+        finally:
+            self.auxiliary.value = None
+
+    def __normalize(self, message: Dict) -> Tuple[str, str]:
+        return message["User"], message["Message"].strip()
+
+    def __pending_messages(self, history: List[Dict], system_prompt: str) -> List[Dict] | None:
+        """Return the messages of history the session has not evaluated yet, None if it can't be reused.
+
+        The window only sends the last messages of the chat, so the history may have lost its head
+        while the session still holds it: it is enough that it starts with the tail of the session.
+        """
+        if self.session is None or system_prompt != self.session_system_prompt:
+            return None
+        done = [self.__normalize(m) for m in self.session_messages]
+        new = [self.__normalize(m) for m in history]
+        if len(done) == 0:
+            return history
+        for overlap in range(min(len(done), len(new)), 0, -1):
+            if new[:overlap] == done[-overlap:]:
+                return history[overlap:]
+        return None
+
+    def __generate_once(self, prompt: str, history: List[Dict], generation: int,
+                        on_token: Callable[[str], Any]) -> str:
+        """Generate without changing the chat session, for suggestions and chat names.
+
+        The prompt is evaluated after the session, then the context is moved back to where the session
+        ended, like GPT4All Chat does to regenerate an answer, so the next message still reuses the KV cache.
+        It stops as soon as a message is sent, since the lock of the model is needed to answer it.
+        """
+        text: str = "".join(m["User"] + ": " + m["Message"] + "\n" for m in history) + prompt
+        n_batch: int = int(self.get_setting("n_batch"))
+        response: List[str] = []
+
+        def callback(_id, token: str) -> bool:
+            response.append(token)
+            return not scheduler.superseded(generation) and on_token(token) is not False
+
+        with self.lock:
+            try:
+                context = self.model.model.context
+                if self.session is not None and context is not None and \
+                        context.n_past + estimate_tokens(text) + 200 < int(self.get_setting("n_ctx")):
+                    n_past: int = context.n_past
+                    # _current_prompt_template is the template of the session, set by chat_session
+                    self.model.model.prompt_model(text, self.model._current_prompt_template.format("%1", "%2"),
+                                                  callback, n_predict=200, top_k=1, n_batch=n_batch)
+                    context.n_past = n_past
+                else:
+                    # Without room after the session the context would be shifted, so the session is dropped
+                    self.close_session()
+                    self.model.generate(text, top_k=1, n_batch=n_batch, callback=callback)
+            except Exception as e:
+                logging.error(f"Error generating text with local model: {e}")
+                self.close_session()
+                return f"Error: {e}"
+        return "".join(response).strip()
+
+    def __generate(self, prompt: str, history: List[Dict], system_prompt: List[str],
+                   on_token: Callable[[str], Any] = lambda _: None) -> str:
+        if self.model is None:
+            return _("Model not yet loaded...")
+        generation: int | None = getattr(self.auxiliary, "value", None)
+        if generation is not None:
+            return self.__generate_once(prompt, history, generation, on_token)
+        system: str = "\n".join(system_prompt)
+        # The history has the messages as they are in the chat, without the recalled messages and web results
+        augmented = getattr(self.augmented, "value", None)
+        message: str = augmented[1] if augmented is not None and augmented[0] == prompt else prompt
+        self.augmented.value = None
+        with self.lock:
+            pending = self.__pending_messages(history, system)
+            if pending is None:
+                self.close_session()
+                self.session = contextlib.ExitStack()
+                self.session.enter_context(self.model.chat_session(system))
+                self.session_system_prompt = system
+                pending = history
+            # Only the messages that are not in the session yet are prefilled, the rest is already in the KV cache
+            text: str = "".join(m["User"] + ": " + m["Message"] + "\n" for m in pending) + prompt
+            try:
+                response = self.model.generate(text, top_k=1, n_batch=int(self.get_setting("n_batch")),
+                                               callback=lambda _id, token: on_token(token) is not False)
+            except Exception as e:
+                logging.error(f"Error generating text with local model: {e}")
+                self.close_session()
+                return f"Error: {e}"
+            self.session_messages += pending + [{"User": "User", "Message": message},
+                                                {"User": "Assistant", "Message": response}]
+        return response.strip()
+
+    def generate_text(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = []) -> str:
+        return self.__generate(prompt, history, system_prompt)
+
+    def generate_text_stream(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = [],
+                             on_update: Callable[[str], Any] = lambda _: None, extra_args: List = []) -> str:
+        full_message: str = ""
+
+        def on_token(token: str):
+            nonlocal full_message
+            full_message += token
+            args = (full_message.strip(),) + tuple(extra_args)
+            return on_update(*args)
+
+        return self.__generate(prompt, history, system_prompt, on_token)
@@ -168,5 +168,14 @@ class MyApp(Adw.Application):
 
 
 def main(version: str):
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        from .batch import run_batch
+        return run_batch(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        from .benchmark import run_benchmark_cli
+        return run_benchmark_cli(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "--usage":
+        from .usage import run_usage_report
+        return run_usage_report(sys.argv[2:])
     app = MyApp(application_id="io.github.qwersyk.Newelle", version=version)
-    app.run(sys.argv)
+    return app.run(sys.argv)
@@ -0,0 +1,211 @@
+import os, re, json, zlib, hashlib, threading
+from typing import Dict, List, Set
+from .extra import find_module, estimate_tokens
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+WORD_REGEX = re.compile(r"\w+")
+# Only these messages are worth recalling, console outputs and files are not
+INDEXED_USERS = ("User", "Assistant")
+# Characters of a message kept in the index and injected in the prompt
+MAX_SNIPPET_LENGTH = 1000
+
+
+class HashingVectorizer:
+    """Embeds texts as hashed bag of words and word pairs, normalized for cosine similarity.
+
+    crc32 is used instead of hash() because the vectors are stored and must be stable between runs.
+    """
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    def features(self, text: str) -> List[str]:
+        words = WORD_REGEX.findall(text.lower())
+        return words + [a + " " + b for a, b in zip(words, words[1:])]
+
+    def embed(self, text: str):
+        np = find_module("numpy")
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        features = self.features(text)
+        if not features:
+            return vector
+        hashes = np.array([zlib.crc32(feature.encode()) for feature in features], dtype=np.uint32)
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, hashes % self.dimensions, signs)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SemanticMemory:
+    """Index of the messages of every chat, to recall the ones relevant to a new message.
+
+    Vectors are appended to a float16 file read through a memory map, the messages to a JSONL file
+    next to it, so indexing is incremental and the index is never fully loaded in memory.
+    """
+
+    def __init__(self, path: str, dimensions: int = 512, token_budget: int = 400, results: int = 4,
+                 min_score: float = 0.25):
+        self.path = path
+        self.vectorizer = HashingVectorizer(dimensions)
+        self.token_budget = token_budget
+        self.results = results
+        self.min_score = min_score
+        self.vectors_path: str = os.path.join(path, "vectors.f16")
+        self.entries_path: str = os.path.join(path, "entries.jsonl")
+        self.entries: List[Dict] = []
+        self.ids: Set[str] = set()
+        self.vectors = None
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def is_available() -> bool:
+        return find_module("numpy") is not None
+
+    @staticmethod
+    def message_id(message: Dict) -> str:
+        return hashlib.sha1((message["User"] + "\0" + message["Message"]).encode()).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.entries_path) as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except FileNotFoundError:
+            pass
+        rows: int = 0
+        if os.path.exists(self.vectors_path):
+            rows = os.path.getsize(self.vectors_path) // (self.vectorizer.dimensions * 2)
+        if rows != len(self.entries):
+            # An interrupted write, keep only the messages that have both a vector and an entry
+            logging.warning("Semantic memory index was not saved completely, truncating it")
+            rows = min(rows, len(self.entries))
+            self.entries = self.entries[:rows]
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(rows * self.vectorizer.dimensions * 2)
+            with open(self.entries_path, "w") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in self.entries)
+        self.ids = {entry["id"] for entry in self.entries}
+
+    def _map_vectors(self):
+        """Return the memory map of the vectors, remapped after new messages were appended"""
+        np = find_module("numpy")
+        if self.vectors is None or self.vectors.shape[0] != len(self.entries):
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r",
+                                     shape=(len(self.entries), self.vectorizer.dimensions)) if self.entries else None
+        return self.vectors
+
+    def index_chats(self, chats: List[Dict]):
+        """Add the messages of the chats that are not indexed yet."""
+        np = find_module("numpy")
+        with self.lock:
+            new_entries: List[Dict] = []
+            vectors: List = []
+            for chat in chats:
+                for message in chat["chat"]:
+                    if message["User"] not in INDEXED_USERS or not message["Message"].strip():
+                        continue
+                    id = self.message_id(message)
+                    if id in self.ids:
+                        continue
+                    self.ids.add(id)
+                    text: str = message["Message"][:MAX_SNIPPET_LENGTH]
+                    new_entries.append({"id": id, "chat": chat["name"], "user": message["User"], "text": text})
+                    vectors.append(self.vectorizer.embed(text))
+            if not new_entries:
+                return
+            try:
+                with open(self.vectors_path, "ab") as f:
+                    f.write(np.array(vectors, dtype=np.float16).tobytes())
+                with open(self.entries_path, "a") as f:
+                    f.writelines(json.dumps(entry) + "\n" for entry in new_entries)
+            except OSError as e:
+                logging.error(f"Error saving semantic memory: {e}")
+                self.ids.difference_update(entry["id"] for entry in new_entries)
+                return
+            self.entries.extend(new_entries)
+
+    def search(self, query: str, exclude: Set[str] = set()) -> List[Dict]:
+        """Return the most similar messages to the query, best first, skipping the ids in exclude."""
+        np = find_module("numpy")
+        with self.lock:
+            vectors = self._map_vectors()
+            if vectors is None:
+                return []
+            query_vector = self.vectorizer.embed(query)
+            scores = np.empty(len(self.entries), dtype=np.float32)
+            # Scored in blocks, so that only a block at a time is converted to float32
+            for start in range(0, len(self.entries), 8192):
+                scores[start:start + 8192] = vectors[start:start + 8192].astype(np.float32) @ query_vector
+            candidates: int = min(len(scores), self.results + len(exclude))
+            best = np.argpartition(-scores, candidates - 1)[:candidates]
+            results: List[Dict] = []
+            for index in best[np.argsort(-scores[best])]:
+                entry = self.entries[index]
+                if scores[index] < self.min_score or entry["id"] in exclude:
+                    continue
+                results.append(dict(entry, score=float(scores[index])))
+                if len(results) >= self.results:
+                    break
+            return results
+
+    def recall(self, query: str, chats: List[Dict], history: List[Dict] = []) -> str:
+        """Index the new messages and return the past messages relevant to the query within the token budget.
+
+        Messages already in history are skipped since the model receives them anyway.
+        """
+        self.index_chats(chats)
+        exclude: Set[str] = {self.message_id(message) for message in history}
+        exclude.add(self.message_id({"User": "User", "Message": query}))
+        recalled: List[str] = []
+        tokens: int = 0
+        for entry in self.search(query, exclude):
+            snippet: str = f"- [{entry['chat']}] {entry['user']}: {entry['text']}"
+            cost: int = estimate_tokens(snippet)
+            if tokens + cost > self.token_budget:
+                continue
+            tokens += cost
+            recalled.append(snippet)
+        return "\n".join(recalled)
+
+    def prune(self, chats: List[Dict]):
+        """Forget the messages that are not in any of the chats anymore, like the ones of a deleted chat."""
+        np = find_module("numpy")
+        kept_ids: Set[str] = {self.message_id(message) for chat in chats for message in chat["chat"]
+                              if message["User"] in INDEXED_USERS}
+        with self.lock:
+            keep: List[int] = [i for i, entry in enumerate(self.entries) if entry["id"] in kept_ids]
+            if len(keep) == len(self.entries):
+                return
+            entries: List[Dict] = [self.entries[i] for i in keep]
+            vectors = np.array(self._map_vectors()[keep], dtype=np.float16)
+            self.vectors = None
+            try:
+                with open(self.vectors_path + ".tmp", "wb") as f:
+                    f.write(vectors.tobytes())
+                with open(self.entries_path + ".tmp", "w") as f:
+                    f.writelines(json.dumps(entry) + "\n" for entry in entries)
+                # Without entries the index is emptied and rebuilt on load if the files are only partly replaced
+                os.remove(self.entries_path)
+                os.replace(self.vectors_path + ".tmp", self.vectors_path)
+                os.replace(self.entries_path + ".tmp", self.entries_path)
+            except OSError as e:
+                logging.error(f"Error saving semantic memory: {e}")
+                return
+            self.entries = entries
+            self.ids = {entry["id"] for entry in entries}
+
+    def clear(self):
+        """Forget every indexed message."""
+        with self.lock:
+            self.entries, self.ids, self.vectors = [], set(), None
+            for path in (self.vectors_path, self.entries_path):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,131 @@
+import json, time, threading
+from typing import Any, Callable, Dict, List
+from .llm import LLMHandler
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class StreamRecorder:
+    """Records the streams of a handler, with their timing, appending one JSON line per answer to a file.
+
+    Each line contains the handler key, the prompt, the answer and the events: [seconds since the
+    request, text appended] or [seconds, text, True] when the new text does not continue the previous one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, handler: LLMHandler, prompt: str, on_update: Callable[..., Any],
+               generate: Callable[[Callable[..., Any]], str]) -> str:
+        """Run generate with an on_update that records every update before forwarding it."""
+        events: List[List] = []
+        previous: str = ""
+        start = time.perf_counter()
+
+        def recording_update(message: str, *args):
+            nonlocal previous
+            elapsed = round(time.perf_counter() - start, 4)
+            if message.startswith(previous):
+                events.append([elapsed, message[len(previous):]])
+            else:
+                events.append([elapsed, message, True])
+            previous = message
+            return on_update(message, *args)
+
+        answer: str = generate(recording_update)
+        capture = {"handler": handler.key, "prompt": prompt, "answer": answer,
+                   "duration": round(time.perf_counter() - start, 4), "events": events}
+        with self.lock:
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(capture) + "\n")
+            except OSError as e:
+                logging.error(f"Error saving stream capture: {e}")
+        return answer
+
+
+class ReplayHandler(LLMHandler):
+    """Replays streams captured by StreamRecorder instead of calling a provider"""
+    key: str = "replay"
+    requests_per_minute: float = 0
+
+    def __init__(self, settings: object, path: str):
+        super().__init__(settings, path)
+        self.captures: List[Dict] = []
+        self.position: int = 0
+        self.lock = threading.Lock()
+
+    def get_extra_settings(self) -> List[Dict]:
+        return [
+            {
+                "key": "capture",
+                "title": _("Capture file"),
+                "description": _("JSONL file recorded with NEWELLE_RECORD_STREAMS"),
+                "type": "entry",
+                "default": ""
+            },
+            {
+                "key": "speed",
+                "title": _("Replay speed"),
+                "description": _("Replay at the recorded speed, faster, or as fast as possible"),
+                "type": "combo",
+                "values": ((_("Original"), "1"), ("2x", "2"), ("10x", "10"), (_("Maximum"), "0")),
+                "default": "1",
+            },
+            {
+                "key": "streaming",
+                "title": _("Message Streaming"),
+                "description": _("Gradually stream message output"),
+                "type": "toggle",
+                "default": True
+            },
+        ]
+
+    def load_model(self, model: str) -> bool:
+        path: str = self.get_setting("capture")
+        self.captures = []
+        self.position = 0
+        try:
+            with open(path) as f:
+                self.captures = [json.loads(line) for line in f if line.strip()]
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Error loading stream capture {path}: {e}")
+            return False
+        return True
+
+    def next_capture(self, prompt: str) -> Dict | None:
+        """Return the capture recorded for this prompt, or the next one in order."""
+        with self.lock:
+            if not self.captures:
+                return None
+            for capture in self.captures:
+                if capture["prompt"] == prompt:
+                    return capture
+            capture = self.captures[self.position % len(self.captures)]
+            self.position += 1
+            return capture
+
+    def generate_text(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = []) -> str:
+        capture = self.next_capture(prompt)
+        return capture["answer"] if capture is not None else _("Error: no stream capture loaded")
+
+    def generate_text_stream(self, prompt: str, history: List[Dict] = [], system_prompt: List[str] = [],
+                             on_update: Callable[[str], Any] = lambda _: None, extra_args: List = []) -> str:
+        capture = self.next_capture(prompt)
+        if capture is None:
+            return _("Error: no stream capture loaded")
+        speed: float = float(self.get_setting("speed"))
+        start = time.perf_counter()
+        message: str = ""
+        for event in capture["events"]:
+            if speed > 0:
+                delay = start + event[0] / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            message = event[1] if len(event) > 2 else message + event[1]
+            if on_update(message, *extra_args) is False:
+                return message
+        return capture["answer"]
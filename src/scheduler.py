@@ -0,0 +1,233 @@
+import threading, time, random, re
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Tuple
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Request priorities, lower values are served first
+FOREGROUND = 0
+AUXILIARY = 1
+
+RETRYABLE_STATUS = {429, 503, 529}
+DURATION_REGEX = re.compile(r"([\d.]+)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# Messages of errors without a status, like the ones of g4f providers, that report a rate limit
+RATE_LIMIT_REGEX = re.compile(r"\b429\b.{0,40}too many requests|too many requests.{0,40}\b429\b"
+                              r"|\brate[ _-]?limit(s|ed|ing)?\b", re.IGNORECASE | re.DOTALL)
+# Sent with a 429 when the account is out of credit, retrying does not help
+BILLING_CODES = ("insufficient_quota", "billing_hard_limit_reached", "billing_not_active", "access_terminated")
+BILLING_REGEX = re.compile(r"\b(" + "|".join(BILLING_CODES) + r")\b")
+
+
+class RequestCancelled(Exception):
+    """Raised for an auxiliary request cancelled because a foreground request started before it could run."""
+
+
+class RateLimited(Exception):
+    """Raised when a provider refuses a request because of rate limits."""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_duration(value: str) -> float | None:
+    """Parse a delay like "20", "1.5s", "20ms" or "6m0s" in seconds."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_REGEX.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers: Any) -> float | None:
+    """Return how many seconds to wait according to Retry-After or rate limit reset headers."""
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is not None:
+        delay = parse_duration(value)
+        if delay is not None:
+            return delay
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    for key in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens", "x-ratelimit-reset"):
+        value = headers.get(key)
+        if value is not None:
+            delay = parse_duration(value)
+            if delay is not None:
+                return delay
+    return None
+
+
+def as_rate_limit(error: Exception) -> RateLimited | None:
+    """Return a RateLimited for errors caused by rate limits or overload, None for the others."""
+    if isinstance(error, RateLimited):
+        return error
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status is None and isinstance(getattr(error, "code", None), int):
+        status = error.code
+    headers = getattr(response, "headers", None)
+    if getattr(error, "code", None) in BILLING_CODES or BILLING_REGEX.search(str(error)):
+        return None
+    if status in RETRYABLE_STATUS:
+        return RateLimited(str(error), parse_retry_after(headers))
+    if status is None and RATE_LIMIT_REGEX.search(str(error)):
+        return RateLimited(str(error))
+    return None
+
+
+class TokenBucket:
+    """Allows rate requests per second with bursts of capacity, serving waiting requests by priority."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+        self.blocked_until: float = 0
+        self.waiting: Dict[int, int] = {}
+        self.condition = threading.Condition()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _first_in_line(self, priority: int) -> bool:
+        return not any(count for p, count in self.waiting.items() if p < priority)
+
+    def acquire(self, priority: int = FOREGROUND):
+        """Block until a request can be sent."""
+        with self.condition:
+            self.waiting[priority] = self.waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self.blocked_until and self.tokens >= 1 and self._first_in_line(priority):
+                        self.tokens -= 1
+                        return
+                    wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.rate else 0)
+                    self.condition.wait(wait if wait > 0 else None)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def block(self, seconds: float):
+        """Refuse every request for the given time, after the provider asked to slow down."""
+        with self.condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    """Sends provider requests through a token bucket per provider and API key, retrying rate limited ones.
+
+    Auxiliary requests (suggestions, chat names) only run once no foreground request has been active
+    for idle_delay seconds, and the ones still waiting are cancelled when a new foreground request starts.
+    The running ones stop themselves by checking superseded.
+    """
+
+    def __init__(self, max_retries: int = 4, base_delay: float = 1, max_delay: float = 60, idle_delay: float = 1):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idle_delay = idle_delay
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition()
+        self.foreground_active: int = 0
+        self.foreground_ended: float = 0
+        # Incremented by every foreground request, auxiliary requests queued before it are cancelled
+        self.generation: int = 0
+
+    @contextmanager
+    def foreground(self):
+        """Mark a foreground generation as running, cancelling the auxiliary requests still waiting."""
+        with self.idle:
+            self.foreground_active += 1
+            self.generation += 1
+            self.idle.notify_all()
+        try:
+            yield
+        finally:
+            with self.idle:
+                self.foreground_active -= 1
+                self.foreground_ended = time.monotonic()
+                self.idle.notify_all()
+
+    def superseded(self, generation: int) -> bool:
+        """Return if a foreground request started after generation, running auxiliary requests check it to stop."""
+        return self.generation != generation
+
+    def wait_idle(self, generation: int):
+        """Block until no foreground request is running, raise RequestCancelled if a new one started."""
+        with self.idle:
+            while True:
+                if self.generation != generation:
+                    raise RequestCancelled()
+                if self.foreground_active:
+                    self.idle.wait()
+                    continue
+                remaining = self.foreground_ended + self.idle_delay - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.idle.wait(remaining)
+
+    def get_bucket(self, key: Tuple[str, str], requests_per_minute: float) -> TokenBucket:
+        with self.lock:
+            if key not in self.buckets:
+                rate = requests_per_minute / 60
+                self.buckets[key] = TokenBucket(rate, max(1.0, requests_per_minute / 6))
+            return self.buckets[key]
+
+    def backoff(self, attempt: int, retry_after: float | None) -> float:
+        """Delay before retrying: what the provider asked for, or exponential with jitter."""
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay / 2)
+        return random.uniform(0.5, 1) * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+    def run(self, key: Tuple[str, str], requests_per_minute: float, func: Callable, *args,
+            priority: int = FOREGROUND) -> Any:
+        """Call func(*args) once the bucket of key allows it, retrying it while it raises RateLimited.
+
+        requests_per_minute <= 0 disables the bucket, only the retries are applied.
+        Auxiliary requests first wait for the foreground to be idle and may raise RequestCancelled.
+        """
+        bucket = self.get_bucket(key, requests_per_minute) if requests_per_minute > 0 else None
+        generation = self.generation
+        for attempt in range(self.max_retries + 1):
+            if priority != FOREGROUND:
+                self.wait_idle(generation)
+            if bucket is not None:
+                bucket.acquire(priority)
+            try:
+                return func(*args)
+            except RateLimited as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e.retry_after)
+                logging.warning(f"Rate limited by {key[0]}, retrying in {delay:.1f}s: {e}")
+                if bucket is not None:
+                    bucket.block(delay)
+                else:
+                    time.sleep(delay)
+
+
+scheduler = RequestScheduler()
@@ -1,6 +1,6 @@
 from typing import Any, Dict, List, Callable, Tuple
 import gi
-import re, threading, os, json, time, ctypes
+import re, threading, os, json
 from subprocess import Popen
 from gi.repository import Gtk, Adw, Gio, GLib
 
@@ -12,7 +12,9 @@ from .constants import AVAILABLE_LLMS, AVAILABLE_PROMPTS, AVAILABLE_TTS, AVAILAB
 from gpt4all import GPT4All
 from .llm import GPT4AllHandler, LLMHandler
 from .gtkobj import ComboRowHelper, CopyBox, MultilineEntry
-from .extra import can_escape_sandbox, override_prompts, human_readable_size
+from .extra import can_escape_sandbox, override_prompts, human_readable_size, install_module
+from .memory import SemanticMemory
+from .download import Download, download_manager
 import logging
 
 # Set up logging
@@ -25,7 +27,6 @@ class Settings(Adw.PreferencesWindow):
         if not headless:
             self.set_transient_for(app.win)
         self.set_modal(True)
-        self.downloading: Dict[str, bool] = {}
         self.slider_labels: Dict[Gtk.Scale, Gtk.Label] = {}
         self.local_models: List[Dict] = json.loads(self.settings.get_string("available-models"))
         self.directory: str = GLib.get_user_config_dir()
@@ -136,6 +137,23 @@ class Settings(Adw.PreferencesWindow):
             switch.set_active(self.settings.get_boolean("virtualization"))
         switch.connect("state-set", self.toggle_virtualization)
         self.neural_network.add(row)
+        row = Adw.ActionRow(title=_("Concurrent commands"), subtitle=_("How many console commands of different chats can run at the same time, the commands of a chat always run in order"))
+        int_spin = Gtk.SpinButton(valign=Gtk.Align.CENTER)
+        int_spin.set_adjustment(Gtk.Adjustment(lower=1, upper=16, step_increment=1, page_increment=4, page_size=0))
+        row.add_suffix(int_spin)
+        self.settings.bind("console-jobs", int_spin, 'value', Gio.SettingsBindFlags.DEFAULT)
+        self.neural_network.add(row)
+        row = Adw.ExpanderRow(title=_("Persistent shell session"), subtitle=_("Run the commands of a chat in the same shell, keeping the folder and variables between them"))
+        switch = Gtk.Switch(valign=Gtk.Align.CENTER)
+        row.add_suffix(switch)
+        self.settings.bind("console-session", switch, 'active', Gio.SettingsBindFlags.DEFAULT)
+        timeout_row = Adw.ActionRow(title=_("Command timeout"), subtitle=_("Seconds after which a command is stopped and the shell restarted"))
+        int_spin = Gtk.SpinButton(valign=Gtk.Align.CENTER)
+        int_spin.set_adjustment(Gtk.Adjustment(lower=5, upper=3600, step_increment=5, page_increment=60, page_size=0))
+        timeout_row.add_suffix(int_spin)
+        self.settings.bind("console-timeout", int_spin, 'value', Gio.SettingsBindFlags.DEFAULT)
+        row.add_row(timeout_row)
+        self.neural_network.add(row)
         row = Adw.ExpanderRow(title=_("External Terminal"), subtitle=_("Choose the external terminal where to run the console commands"))
         entry = Gtk.Entry()
         self.settings.bind("external-terminal", entry, 'text', Gio.SettingsBindFlags.DEFAULT)
@@ -147,6 +165,18 @@ class Settings(Adw.PreferencesWindow):
         row.add_suffix(int_spin)
         self.settings.bind("memory", int_spin, 'value', Gio.SettingsBindFlags.DEFAULT)
         self.neural_network.add(row)
+        row = Adw.ExpanderRow(title=_("Semantic memory"), subtitle=_("Recall relevant messages from all the chats, requires numpy"))
+        switch = Gtk.Switch(valign=Gtk.Align.CENTER)
+        row.add_suffix(switch)
+        self.settings.bind("semantic-memory", switch, 'active', Gio.SettingsBindFlags.DEFAULT)
+        switch.connect("notify::active", self.toggle_semantic_memory)
+        budget_row = Adw.ActionRow(title=_("Recalled tokens"), subtitle=_("Maximum size of the recalled messages added to the prompt"))
+        int_spin = Gtk.SpinButton(valign=Gtk.Align.CENTER)
+        int_spin.set_adjustment(Gtk.Adjustment(lower=50, upper=4000, step_increment=50, page_increment=500, page_size=0))
+        budget_row.add_suffix(int_spin)
+        self.settings.bind("semantic-memory-tokens", int_spin, 'value', Gio.SettingsBindFlags.DEFAULT)
+        row.add_row(budget_row)
+        self.neural_network.add(row)
 
     def build_row(self, constants: Dict, key: str, selected: str, group: Gtk.CheckButton) -> Adw.ActionRow | Adw.ExpanderRow:
         model: Dict = constants[key]
@@ -310,6 +340,10 @@ class Settings(Adw.PreferencesWindow):
         else:
             self.settings.set_boolean("virtualization", status)
 
+    def toggle_semantic_memory(self, switch: Gtk.Switch, *a):
+        if switch.get_active() and not SemanticMemory.is_available():
+            threading.Thread(target=install_module, args=("numpy", os.path.join(self.directory, "pip"))).start()
+
     def open_website(self, button: Gtk.Button):
         try:
             Popen(["flatpak-spawn", "--host", "xdg-open", button.get_name()])
@@ -428,7 +462,6 @@ class Settings(Adw.PreferencesWindow):
                 if len(self.gpt.get_custom_model_list()) == 0:
                     button.set_sensitive(False)
         self.rows: Dict[str, Dict] = {}
-        self.model_threads: Dict[str, List] = {}
         for model in self.local_models:
             available: bool = self.gpt.model_available(model["filename"])
             active: bool = model["filename"] == self.settings.get_string("local-model")
@@ -461,7 +494,7 @@ class Settings(Adw.PreferencesWindow):
 
     def download_local_model(self, button: Gtk.Button):
         model: str = button.get_name()
-        filesize: int = next((x["filesize"] for x in self.local_models if x["filename"] == model), 0)
+        info: Dict = next((x for x in self.local_models if x["filename"] == model), {})
         box = Gtk.Box(homogeneous=True, spacing=4)
         box.set_orientation(Gtk.Orientation.VERTICAL)
         icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name="folder-download-symbolic"))
@@ -473,47 +506,40 @@ class Settings(Adw.PreferencesWindow):
         button.set_child(box)
         button.disconnect_by_func(self.download_local_model)
         button.connect("clicked", self.remove_local_model)
-        th = threading.Thread(target=self.download_model_thread, args=(model, button, progress))
-        self.model_threads[model] = [th, 0]
-        th.start()
-
-    def update_download_status(self, model: str, filesize: int, progressbar: Gtk.ProgressBar):
-        file: str = os.path.join(self.gpt.modelspath, model) + ".part"
-        while model in self.downloading and self.downloading[model]:
-            try:
-                currentsize: int = os.path.getsize(file)
-                perc: float = currentsize / int(filesize)
-                progressbar.set_fraction(perc)
-            except Exception as e:
-                logging.error(f"Error updating download status: {e}")
-            time.sleep(1)
-
-    def download_model_thread(self, model: str, button: Gtk.Button, progressbar: Gtk.ProgressBar):
-        self.model_threads[model][1] = threading.current_thread().ident
-        self.downloading[model] = True
-        threading.Thread(target=self.update_download_status, args=(model, self.local_models[self.local_models.index(next((x for x in self.local_models if x["filename"] == model), {}))]["filesize"], progressbar)).start()
-        self.gpt.download_model(model)
-        icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name="user-trash-symbolic"))
+        download_manager.download(
+            info.get("url", "https://gpt4all.io/models/gguf/" + model),
+            os.path.join(self.gpt.modelspath, model),
+            checksum=info.get("md5sum"),
+            algorithm="md5",
+            connections=4,
+            on_progress=lambda done, total: GLib.idle_add(progress.set_fraction, done / total if total else 0),
+            on_done=lambda download: GLib.idle_add(self.download_finished, download, button),
+        )
+
+    def download_finished(self, download: Download, button: Gtk.Button):
+        model: str = button.get_name()
+        if download.cancelled:
+            return
+        if download.error is not None:
+            self.add_toast(Adw.Toast(title=_("Error downloading {0}").format(model), timeout=2))
+            icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name="folder-download-symbolic"))
+            button.disconnect_by_func(self.remove_local_model)
+            button.connect("clicked", self.download_local_model)
+        else:
+            icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name="user-trash-symbolic"))
+            button.add_css_class("error")
+            button.remove_css_class("accent")
+            self.rows[model]["radio"].set_sensitive(True)
         icon.set_icon_size(Gtk.IconSize.INHERIT)
-        button.add_css_class("error")
         button.set_child(icon)
-        self.downloading[model] = False
-        self.rows[model]["radio"].set_sensitive(True)
 
     def remove_local_model(self, button: Gtk.Button):
         model: str = button.get_name()
-        if model in self.downloading and self.downloading[model]:
-            self.downloading[model] = False
-            if model in self.model_threads:
-                thid = self.model_threads[model][1]
-                res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thid), ctypes.py_object(SystemExit))
-                if res > 1:
-                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thid), 0)
+        path: str = os.path.join(self.gpt.modelspath, model)
+        download_manager.cancel(path, remove=True)
         try:
-            os.remove(os.path.join(self.gpt.modelspath, model))
-            button.add_css_class("accent")
-            if model in self.downloading:
-                self.downloading[model] = False
+            if os.path.exists(path):
+                os.remove(path)
             icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name="folder-download-symbolic"))
             button.disconnect_by_func(self.remove_local_model)
             button.connect("clicked", self.download_local_model)
@@ -521,6 +547,7 @@ class Settings(Adw.PreferencesWindow):
             button.remove_css_class("error")
             icon.set_icon_size(Gtk.IconSize.INHERIT)
             button.set_child(icon)
+            self.rows[model]["radio"].set_sensitive(False)
         except Exception as e:
             logging.error(f"Error removing local model: {e}")
 
@@ -0,0 +1,136 @@
+import os, signal, select, subprocess, threading, time, uuid, codecs
+from typing import List, Tuple
+from .extra import OutputRingBuffer, quote_string
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Exit status reported for commands that timed out, like the timeout command does
+TIMEOUT_STATUS = 124
+
+
+class TicketLock:
+    """A lock acquired in the order it was requested, threading.Lock can let a later waiter in first"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.next_ticket: int = 0
+        self.serving: int = 0
+
+    def __enter__(self):
+        with self.condition:
+            ticket: int = self.next_ticket
+            self.next_ticket += 1
+            while ticket != self.serving:
+                self.condition.wait()
+
+    def __exit__(self, *a):
+        with self.condition:
+            self.serving += 1
+            self.condition.notify_all()
+
+
+class ShellSession:
+    """A long lived bash process the console blocks of a chat run in.
+
+    cd and variables carry over between blocks and no process is spawned per command. Each command is
+    followed by a random sentinel printed with its exit status and working directory, that marks where
+    its output ends. A session that exited or timed out is started again by the next command.
+    """
+
+    def __init__(self, host: bool):
+        self.host = host
+        self.process: subprocess.Popen | None = None
+        self.cwd: str | None = None
+        # Commands run in the order they were sent
+        self.lock = TicketLock()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        arguments: List[str] = ["bash", "--noprofile", "--norc"]
+        if self.host:
+            arguments = ["flatpak-spawn", "--host"] + arguments
+        # In its own process group, so that a command that timed out is killed with its children
+        self.process = subprocess.Popen(arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, start_new_session=True)
+        self.cwd = None
+
+    def run(self, script: str, output: OutputRingBuffer, cwd: str, timeout: float = 0) -> Tuple[int, str | None]:
+        """Run a script in cwd, streaming its output to output.
+
+        Returns the exit status and the working directory the script left the shell in, None if the shell exited.
+        Commands run one at a time, a timeout of 0 waits forever.
+        """
+        with self.lock:
+            if not self.is_alive():
+                if self.process is not None:
+                    logging.warning(f"Shell session exited with status {self.process.returncode}, restarting it")
+                self.start()
+            sentinel: str = uuid.uuid4().hex
+            commands: List[str] = []
+            if cwd != self.cwd:
+                commands.append(f"cd -- {quote_string(cwd)}")
+            # eval keeps a syntax error from swallowing the sentinel, stdin is the session protocol
+            commands.append(f"eval {quote_string(script)} < /dev/null")
+            commands.append(f"printf '\\n%s %d %s\\n' {sentinel} $? \"$PWD\"")
+            try:
+                self.process.stdin.write(("\n".join(commands) + "\n").encode())
+                self.process.stdin.flush()
+            except OSError as e:
+                logging.error(f"Error writing to the shell session: {e}")
+                self.kill()
+                output.append(str(e))
+                return 1, None
+            return self._read_result(sentinel, output, timeout)
+
+    def _read_result(self, sentinel: str, output: OutputRingBuffer, timeout: float) -> Tuple[int, str | None]:
+        fd: int = self.process.stdout.fileno()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        marker: str = "\n" + sentinel + " "
+        pending: str = ""
+        deadline: float | None = time.monotonic() + timeout if timeout else None
+        while True:
+            remaining: float | None = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self.kill()
+                output.append(pending + f"\nTimed out after {timeout} seconds, the shell session was restarted")
+                return TIMEOUT_STATUS, None
+            ready, _write, _error = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk: bytes = os.read(fd, 65536)
+            if not chunk:
+                # The script ran exit, or the shell crashed
+                output.append(pending + decoder.decode(b"", final=True))
+                self.process.wait()
+                return self.process.returncode, None
+            pending += decoder.decode(chunk)
+            index: int = pending.find(marker)
+            if index == -1:
+                # Everything but what could be the start of the marker is shown as it arrives
+                if len(pending) > len(marker):
+                    output.append(pending[:-len(marker)])
+                    pending = pending[-len(marker):]
+                continue
+            end: int = pending.find("\n", index + len(marker))
+            if end == -1:
+                continue
+            output.append(pending[:index])
+            status, _space, self.cwd = pending[index + len(marker):end].partition(" ")
+            return int(status), self.cwd
+
+    def kill(self):
+        """Stop the shell and the command it runs, the next command starts a new session."""
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(2)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        except ProcessLookupError:
+            pass
@@ -1,6 +1,8 @@
 import gi
-from gi.repository import Gtk, Adw, Gio, Pango
-import time
+from gi.repository import Gtk, Adw, Gio, Pango, GLib
+from .gtkobj import ConsoleView
+from .jobs import ConsoleJob, QUEUED, RUNNING, DONE, CANCELLED
+import time, threading
 import logging
 
 # Set up logging
@@ -21,64 +23,117 @@ class ThreadEditing(Gtk.Window):
         button_reload.connect("clicked", self.update_window)
         header.pack_end(button_reload)
         self.app = app
+        # Widgets of the jobs shown, updated in place so that the open consoles stay open
+        self.rows = {}
+        self.update_queued = False
+        self.update_lock = threading.Lock()
+        self.app.win.job_scheduler.listeners.append(self.queue_update)
+        # Refreshes the elapsed times while jobs run
+        self.timer = GLib.timeout_add_seconds(1, self.update_running)
+        self.connect("close-request", self.on_close)
         self.update_window()
 
+    def on_close(self, *a):
+        self.app.win.job_scheduler.listeners.remove(self.queue_update)
+        GLib.source_remove(self.timer)
+        return False
+
+    def queue_update(self):
+        """Called by the job scheduler from the job threads"""
+        with self.update_lock:
+            if self.update_queued:
+                return
+            self.update_queued = True
+        GLib.idle_add(self.update_window)
+
+    def update_running(self):
+        for job, row in self.rows.items():
+            if job.state in (QUEUED, RUNNING):
+                self.update_row(job, row)
+        return True
+
     def update_window(self, *a):
+        # Cleared before reading the jobs, a change after this queues another update
+        with self.update_lock:
+            self.update_queued = False
+        jobs = list(self.app.win.streams)
+        if len(jobs) == 0 or not self.rows or any(job not in jobs for job in self.rows):
+            self.build_window(jobs)
+        for i, job in enumerate(jobs):
+            if job not in self.rows:
+                self.rows[job] = self.build_row(job, i)
+                self.main.append(self.rows[job]["menu"])
+            self.update_row(job, self.rows[job])
+        return False
+
+    def build_window(self, jobs):
+        self.rows = {}
         scrolled_window = Gtk.ScrolledWindow()
         scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
-        main = Gtk.Box(margin_top=10, margin_start=10, margin_bottom=10, margin_end=10, valign=Gtk.Align.START,
-                       halign=Gtk.Align.CENTER, orientation=Gtk.Orientation.VERTICAL)
-        if len(self.app.win.streams) == 0:
-            main.set_opacity(0.4)
-            main.set_vexpand(True)
-            main.set_valign(Gtk.Align.CENTER)
+        self.main = Gtk.Box(margin_top=10, margin_start=10, margin_bottom=10, margin_end=10, valign=Gtk.Align.START,
+                            halign=Gtk.Align.CENTER, orientation=Gtk.Orientation.VERTICAL)
+        if len(jobs) == 0:
+            self.main.set_opacity(0.4)
+            self.main.set_vexpand(True)
+            self.main.set_valign(Gtk.Align.CENTER)
             icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name="network-offline-symbolic"))
             icon.set_css_classes(["empty-folder"])
             icon.set_valign(Gtk.Align.END)
             icon.set_vexpand(True)
-            main.append(icon)
-            main.append(Gtk.Label(label=_("No threads are running"), vexpand=True, valign=Gtk.Align.START,
-                                  css_classes=["empty-folder", "heading"]))
-        else:
-            for i in range(len(self.app.win.streams)):
-                stream_menu = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, css_classes=["card"], margin_top=10,
-                                      margin_start=10, margin_end=10, margin_bottom=10)
-                stream_menu.set_size_request(300, -1)
-                box = Gtk.Box(margin_top=10, margin_start=10, margin_end=10, margin_bottom=10)
-                box.append(Gtk.Label(label=_("Thread number: ") + str(i + 1)))
-                button = Gtk.Button(margin_start=5, margin_end=5, valign=Gtk.Align.CENTER, halign=Gtk.Align.END,
-                                    hexpand=True)
-                button.connect("clicked", self.stop_flow)
-                button.set_name(str(i))
-                box.append(button)
-                stream_menu.append(box)
-                main.append(stream_menu)
-                icon_name = "media-playback-stop-symbolic"
-                if self.app.win.streams[i].poll() is not None:
-                    try:
-                        code = str(self.app.win.streams[i].communicate()[0].decode())
-                    except Exception as e:
-                        logging.error(f"Error communicating with stream {i}: {e}")
-                        code = _("Error getting stream output")
-
-                    icon_name = "emblem-ok-symbolic"
-                    button.set_sensitive(False)
-                    text_expander = Gtk.Expander(
-                        label="Console", css_classes=["toolbar", "osd"], margin_start=10, margin_bottom=10,
-                        margin_end=10
-                    )
-                    text_expander.set_child(Gtk.Label(wrap=True, wrap_mode=Pango.WrapMode.WORD_CHAR, label=code,
-                                                      selectable=True))
-                    stream_menu.append(text_expander)
-                icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name=icon_name))
-                icon.set_icon_size(Gtk.IconSize.INHERIT)
-                button.set_child(icon)
-        scrolled_window.set_child(main)
+            self.main.append(icon)
+            self.main.append(Gtk.Label(label=_("No threads are running"), vexpand=True, valign=Gtk.Align.START,
+                                       css_classes=["empty-folder", "heading"]))
+        scrolled_window.set_child(self.main)
         self.set_child(scrolled_window)
 
-    def stop_flow(self, widget: Gtk.Button):
+    def build_row(self, job: ConsoleJob, i: int) -> dict:
+        stream_menu = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, css_classes=["card"], margin_top=10,
+                              margin_start=10, margin_end=10, margin_bottom=10)
+        stream_menu.set_size_request(300, -1)
+        box = Gtk.Box(margin_top=10, margin_start=10, margin_end=10, margin_bottom=10, spacing=6)
+        labels = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, hexpand=True)
+        labels.append(Gtk.Label(label=_("Thread number: ") + str(i + 1), halign=Gtk.Align.START))
+        labels.append(Gtk.Label(label=job.command, halign=Gtk.Align.START, ellipsize=Pango.EllipsizeMode.END,
+                                max_width_chars=40, css_classes=["monospace", "dim-label"]))
+        status = Gtk.Label(halign=Gtk.Align.START, css_classes=["caption"])
+        labels.append(status)
+        box.append(labels)
+        button = Gtk.Button(margin_start=5, margin_end=5, valign=Gtk.Align.CENTER, halign=Gtk.Align.END)
+        button.connect("clicked", self.stop_flow, job)
+        box.append(button)
+        stream_menu.append(box)
+        text_expander = Gtk.Expander(label="Console", css_classes=["toolbar", "osd"], margin_start=10,
+                                     margin_bottom=10, margin_end=10)
+        stream_menu.append(text_expander)
+        return {"menu": stream_menu, "status": status, "button": button, "expander": text_expander}
+
+    def update_row(self, job: ConsoleJob, row: dict):
+        if job.state == QUEUED:
+            status = _("Queued for {0:.0f}s").format(job.wait_time())
+        elif job.state == RUNNING:
+            status = _("Running for {0:.0f}s").format(job.run_time())
+        elif job.state == CANCELLED:
+            status = _("Stopped")
+        elif job.returncode is None:
+            status = _("Could not run: {0}").format(job.error or _("unknown error"))
+        else:
+            status = _("Exit status {0} after {1:.1f}s").format(job.returncode, job.run_time())
+            if job.cpu_time is not None:
+                status += _(", CPU {0:.1f}s, memory {1:.0f} MB").format(job.cpu_time, job.max_rss / 1024)
+        row["status"].set_label(status)
+        icon_name = "media-playback-stop-symbolic"
+        if job.state not in (QUEUED, RUNNING):
+            icon_name = "emblem-ok-symbolic" if job.state == DONE else "dialog-error-symbolic"
+            row["button"].set_sensitive(False)
+        icon = Gtk.Image.new_from_gicon(Gio.ThemedIcon(name=icon_name))
+        icon.set_icon_size(Gtk.IconSize.INHERIT)
+        row["button"].set_child(icon)
+        if job.state != QUEUED and row["expander"].get_child() is None:
+            row["expander"].set_child(ConsoleView(job.output))
+
+    def stop_flow(self, widget: Gtk.Button, job: ConsoleJob):
         try:
-            self.app.win.streams[int(widget.get_name())].terminate()
-            self.update_window()
-        except IndexError as e:
+            job.terminate()
+        except OSError as e:
             logging.error(f"Error terminating stream: {e}")
+        self.update_window()
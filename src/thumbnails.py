@@ -0,0 +1,165 @@
+import os, hashlib, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from gi.repository import Gdk, GdkPixbuf, GLib
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp")
+
+
+class ThumbnailCache:
+    """Loads images scaled down to a maximum size on worker threads.
+
+    Decoded textures are kept in a memory LRU bounded in bytes, and the scaled images are saved in a
+    disk cache keyed by path, modification time and size, so a changed file is decoded again.
+    The disk cache is bounded too, the thumbnails used least recently are deleted first.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 64 * 1024 * 1024, workers: int = 2,
+                 max_disk_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        # Size of the disk cache, computed when the first thumbnail is saved
+        self.disk_bytes: int | None = None
+        self.textures: OrderedDict = OrderedDict()
+        self.used_bytes: int = 0
+        self.pending: Dict[str, List[Callable]] = {}
+        self.lock = threading.Lock()
+        # Separate from lock, so that the main thread never waits for an eviction
+        self.disk_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnails")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def is_image(path: str) -> bool:
+        return path.lower().endswith(IMAGE_EXTENSIONS)
+
+    @staticmethod
+    def key(path: str, size: int) -> str | None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return hashlib.sha1(f"{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{size}".encode()).hexdigest()
+
+    def load(self, path: str, size: int, callback: Callable[[Gdk.Texture | None], None] | None = None):
+        """Load the image at most size pixels wide and high, calling callback with the texture in the main thread.
+
+        Requests for an image already being decoded wait for the same decoding.
+        """
+        path = os.path.expanduser(path)
+        key: str | None = self.key(path, size)
+        if key is None:
+            if callback is not None:
+                callback(None)
+            return
+        with self.lock:
+            texture: Gdk.Texture | None = self.textures.get(key)
+            if texture is not None:
+                self.textures.move_to_end(key)
+            elif key in self.pending:
+                if callback is not None:
+                    self.pending[key].append(callback)
+                return
+            else:
+                self.pending[key] = [callback] if callback is not None else []
+                self.executor.submit(self._decode, path, size, key)
+                return
+        if callback is not None:
+            callback(texture)
+
+    def prefetch(self, path: str, size: int):
+        """Start decoding an image that will be shown soon, can be called from any thread."""
+        self.load(path, size)
+
+    def _decode(self, path: str, size: int, key: str):
+        cache_path: str = os.path.join(self.cache_dir, key + ".png")
+        texture: Gdk.Texture | None = None
+        try:
+            if os.path.exists(cache_path):
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(cache_path)
+                # The modification time orders the thumbnails by last use for the eviction
+                os.utime(cache_path)
+            else:
+                _format, width, height = GdkPixbuf.Pixbuf.get_file_info(path)
+                if width <= size and height <= size:
+                    # Small images are shown as they are, not enlarged
+                    pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+                else:
+                    # The loaders decode directly at the reduced size, the full image is never in memory
+                    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(path, size, size, True)
+                self._save(pixbuf, cache_path)
+            texture = Gdk.Texture.new_for_pixbuf(pixbuf)
+        except GLib.Error as e:
+            logging.error(f"Error loading image {path}: {e.message}")
+        except (OSError, TypeError) as e:
+            # get_file_info returns None for files that are not images
+            logging.error(f"Error loading image {path}: {e}")
+        GLib.idle_add(self._loaded, key, texture)
+
+    def _save(self, pixbuf: GdkPixbuf.Pixbuf, cache_path: str):
+        # Written to a temporary file first, so that an interrupted write never leaves a broken thumbnail
+        temporary_path: str = f"{cache_path}.{threading.get_ident()}.tmp"
+        try:
+            pixbuf.savev(temporary_path, "png", [], [])
+            os.replace(temporary_path, cache_path)
+            saved: int = os.path.getsize(cache_path)
+        except (GLib.Error, OSError) as e:
+            logging.warning(f"Error saving thumbnail: {e}")
+            return
+        with self.disk_lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for _path, size, _mtime in self._disk_entries())
+            else:
+                self.disk_bytes += saved
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _disk_entries(self) -> List[Tuple[str, int, float]]:
+        entries: List[Tuple[str, int, float]] = []
+        with os.scandir(self.cache_dir) as iterator:
+            for entry in iterator:
+                if entry.name.endswith(".png"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict_disk(self):
+        """Delete the thumbnails used least recently until the disk cache is at 3/4 of its limit"""
+        entries: List[Tuple[str, int, float]] = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        self.disk_bytes = sum(size for _path, size, _mtime in entries)
+        for path, size, _mtime in entries:
+            if self.disk_bytes <= self.max_disk_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+                self.disk_bytes -= size
+            except OSError as e:
+                logging.warning(f"Error removing thumbnail: {e}")
+
+    def _loaded(self, key: str, texture: Gdk.Texture | None):
+        with self.lock:
+            callbacks: List[Callable] = self.pending.pop(key, [])
+            if texture is not None:
+                self.textures[key] = texture
+                self.used_bytes += texture.get_width() * texture.get_height() * 4
+                while self.used_bytes > self.max_bytes and len(self.textures) > 1:
+                    _key, old = self.textures.popitem(last=False)
+                    self.used_bytes -= old.get_width() * old.get_height() * 4
+        for callback in callbacks:
+            callback(texture)
+        return False
+
+    def clear(self):
+        """Forget the textures in memory, the disk cache is kept."""
+        with self.lock:
+            self.textures.clear()
+            self.used_bytes = 0
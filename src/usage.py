@@ -0,0 +1,144 @@
+import sys, os, csv, json, time, threading, argparse
+from typing import Any, Callable, Dict, IO, List
+from gi.repository import GLib
+from .extra import estimate_tokens
+import logging
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Fields of the aggregated reports, in the order of the CSV columns
+REPORT_FIELDS = ["calls", "errors", "prompt_tokens", "completion_tokens", "duration", "average_duration",
+                 "average_ttft", "tokens_per_second"]
+
+
+def default_usage_path() -> str:
+    return os.path.join(GLib.get_user_data_dir(), "usage.jsonl")
+
+
+class UsageMeter:
+    """Measures the latency of one call to a handler"""
+
+    def __init__(self):
+        self.start: float = time.perf_counter()
+        self.first: float | None = None
+
+    def wrap(self, on_update: Callable[..., Any]) -> Callable[..., Any]:
+        """Return an on_update that records when the first token arrives before forwarding it."""
+        def update(*args):
+            if self.first is None:
+                self.first = time.perf_counter()
+            return on_update(*args)
+        return update
+
+    def finish(self, prompt_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+        duration: float = time.perf_counter() - self.start
+        # Streaming speed is measured after the first token, so that it does not include the prompt processing
+        generation: float = time.perf_counter() - self.first if self.first is not None else duration
+        return {
+            "time": time.time(),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "ttft": round(self.first - self.start, 4) if self.first is not None else None,
+            "duration": round(duration, 4),
+            "tokens_per_second": round(completion_tokens / generation, 2) if generation > 0 else None,
+        }
+
+
+def count_prompt_tokens(prompt: str, history: List[Dict], system_prompt: List[str]) -> int:
+    """Estimate the prompt tokens, for the providers that do not report them."""
+    return estimate_tokens(prompt) + sum(estimate_tokens(message["Message"]) for message in history) \
+        + sum(estimate_tokens(text) for text in system_prompt)
+
+
+class UsageTracker:
+    """Appends one JSON line per handler call to a file, and aggregates them in reports"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, record: Dict[str, Any]):
+        with self.lock:
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                logging.error(f"Error saving usage: {e}")
+
+    def load(self) -> List[Dict[str, Any]]:
+        records: List[Dict] = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    def aggregate(self, by: str) -> Dict[str, Dict[str, Any]]:
+        """Sum the records grouped by a record field: handler, model, chat or kind."""
+        groups: Dict[str, Dict[str, Any]] = {}
+        ttft: Dict[str, List[float]] = {}
+        generation: Dict[str, float] = {}
+        for record in self.load():
+            key: str = str(record.get(by) or "")
+            group = groups.setdefault(key, {field: 0 for field in REPORT_FIELDS})
+            if by == "chat":
+                # The last name of the chat, records made before chats had an id use the name as id
+                group["chat_name"] = record.get("chat_name", key)
+            group["calls"] += 1
+            group["errors"] += bool(record.get("error"))
+            group["prompt_tokens"] += record.get("prompt_tokens", 0)
+            group["completion_tokens"] += record.get("completion_tokens", 0)
+            group["duration"] += record.get("duration", 0)
+            if record.get("ttft") is not None:
+                ttft.setdefault(key, []).append(record["ttft"])
+            if record.get("tokens_per_second"):
+                generation[key] = generation.get(key, 0) + record["completion_tokens"] / record["tokens_per_second"]
+        for key, group in groups.items():
+            group["duration"] = round(group["duration"], 3)
+            group["average_duration"] = round(group["duration"] / group["calls"], 3)
+            group["average_ttft"] = round(sum(ttft[key]) / len(ttft[key]), 3) if key in ttft else None
+            group["tokens_per_second"] = round(group["completion_tokens"] / generation[key], 2) \
+                if generation.get(key) else None
+        return groups
+
+    def export(self, output: IO, by: str | None = None, format: str = "json"):
+        """Write the records, or the report grouped by a field, as JSON or CSV."""
+        if by is None:
+            rows: List[Dict] = self.load()
+            fields: List[str] = sorted({field for row in rows for field in row})
+        else:
+            rows = [dict({by: key}, **group) for key, group in self.aggregate(by).items()]
+            fields = [by] + (["chat_name"] if by == "chat" else []) + REPORT_FIELDS
+        if format == "csv":
+            writer = csv.DictWriter(output, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, output, indent=2)
+            output.write("\n")
+
+
+def run_usage_report(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="newelle --usage",
+                                     description="Report the tokens and latency of the LLM calls")
+    parser.add_argument("--by", choices=["handler", "model", "chat", "kind", "none"], default="handler",
+                        help="Field the calls are grouped by, none exports every call")
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    parser.add_argument("-o", "--output", default="-", help="File where the report is written, - for stdout")
+    parser.add_argument("--input", default=default_usage_path(), help="Usage file recorded by Newelle")
+    args = parser.parse_args(argv)
+
+    tracker = UsageTracker(args.input)
+    output: IO = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        tracker.export(output, None if args.by == "none" else args.by, args.format)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
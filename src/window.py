@@ -3,12 +3,20 @@ import gi, os, subprocess
 import pickle
 from typing import List, Dict, Callable, Tuple, Any
 from .presentation import PresentationWindow
-from .gtkobj import File, CopyBox, BarChartBox, MultilineEntry
+from .gtkobj import File, CopyBox, BarChartBox, MultilineEntry, ChatView, ChatHistoryItem, ExplorerItem, StreamingMessageBox
 from .constants import AVAILABLE_LLMS, AVAILABLE_PROMPTS, PROMPTS, AVAILABLE_TTS, AVAILABLE_STT
 from gi.repository import Gtk, Adw, Pango, Gio, Gdk, GObject, GLib
 from .stt import AudioRecorder
-from .extra import markwon_to_pango, override_prompts, replace_variables
-import threading
+from .replay import StreamRecorder
+from .memory import SemanticMemory
+from .usage import UsageTracker
+from .thumbnails import ThumbnailCache
+from .shell import ShellSession
+from .jobs import JobScheduler, ConsoleJob, run_process
+from .extra import markwon_to_pango, override_prompts, replace_variables, ParseCache, OutputRingBuffer, \
+    StreamingBlockParser
+import threading, functools, uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 import posixpath
 import shlex, json
 import logging
@@ -16,6 +24,71 @@ import logging
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+CODE_BLOCK_REGEX = re.compile(r"```(\w*)\n(.*?)\n```", re.DOTALL)
+CHART_LINE_REGEX = re.compile(r"^\s*(.+?)\s+-\s+([\d.]+)(?:/([\d.]+))?\s*(%?)\s*$")
+
+
+def parse_chart(content: str) -> Tuple[Dict[str, float], bool]:
+    """Parse the "name - value" lines of a chart block, values can be numbers, fractions or percentages"""
+    values: Dict[str, float] = {}
+    percentages: bool = False
+    for line in content.split("\n"):
+        match = CHART_LINE_REGEX.match(line)
+        if match is None:
+            continue
+        try:
+            value = float(match.group(2)) / float(match.group(3) or 1)
+        except (ValueError, ZeroDivisionError):
+            continue
+        values[match.group(1)] = value
+        percentages = percentages or bool(match.group(4))
+    return values, percentages
+
+
+# Increase when the format returned by parse_message changes, to discard the saved results
+PARSE_CACHE_VERSION = 1
+
+
+def parse_message(user: str, text: str) -> List[Tuple]:
+    """Split a message in the parts shown by build_message_widget, with the text already converted to Pango.
+
+    Parts are ("text", markup), ("files", paths), ("image", content), ("chart", content, values, percentages)
+    and ("code", lang, content). The result only depends on the message, so it can be cached.
+    """
+    if user != "Assistant":
+        return [("text", markwon_to_pango(text))]
+    parts: List[Tuple] = []
+    position: int = 0
+    for block in CODE_BLOCK_REGEX.finditer(text):
+        if text[position:block.start()].strip():
+            parts.append(("text", markwon_to_pango(text[position:block.start()].strip())))
+        position = block.end()
+        lang, content = block.group(1), block.group(2)
+        if lang in ["file", "folder"]:
+            parts.append(("files", [path.strip() for path in content.split("\n") if path.strip()]))
+        elif lang == "image":
+            parts.append(("image", content))
+        elif lang == "chart":
+            parts.append(("chart", content) + parse_chart(content))
+        else:
+            parts.append(("code", lang, content))
+    if text[position:].strip():
+        parts.append(("text", markwon_to_pango(text[position:].strip())))
+    return parts
+
+
+# Files added to the explorer at a time while a folder is listed
+EXPLORER_BATCH_SIZE = 200
+# Folder changes received within this delay are applied together
+EXPLORER_COALESCE_DELAY = 150
+# Above this many changed files at once the folder is listed again instead
+EXPLORER_MAX_CHANGES = 500
+EXPLORER_ATTRIBUTES = "standard::name,standard::type,standard::is-hidden"
+# Maximum size in pixels images are decoded at
+CHAT_IMAGE_SIZE = 600
+EXPLORER_THUMBNAIL_SIZE = 96
+
+
 class MainWindow(Gtk.ApplicationWindow):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -29,7 +102,24 @@ class MainWindow(Gtk.ApplicationWindow):
         self.pip_directory: str = os.path.join(self.directory, "pip")
         sys.path.append(self.pip_directory)
         self.filename: str = "chats.pkl"
+        self.usage_tracker = UsageTracker(os.path.join(self.path, "usage.jsonl"))
+        # Console blocks started while the answer is still being generated, see on_stream_block
+        # The blocks of a chat run one after the other, in the order of the answer, since they can depend
+        # on each other. The job scheduler limits how many blocks of different chats run at once.
+        self.console_executors: Dict[int, ThreadPoolExecutor] = {}
+        self.job_scheduler = JobScheduler()
+        # (command, result) of the console blocks of the answer by position, a command can appear twice
+        self.early_console_results: List[Tuple[str, Future | None]] = []
+        # Jobs of the console blocks of the answer, terminated by stop_chat
+        self.answer_jobs: List[ConsoleJob] = []
+        self.answer_jobs_lock = threading.Lock()
+        # Shell sessions of the console blocks, by id of the chat they run for
+        self.shell_sessions: Dict[int, ShellSession] = {}
+        self.thumbnails = ThumbnailCache(os.path.join(GLib.get_user_cache_dir(), "newelle-thumbnails"))
+        self.parse_cache = ParseCache(parse_message, PARSE_CACHE_VERSION,
+                                      path=os.path.join(self.path, "parse_cache.pkl"))
         self._load_chat_history()
+        self.parse_cache.load()
         self._init_settings()
         self._create_ui()
         GLib.idle_add(self.update_folder)
@@ -48,9 +138,17 @@ class MainWindow(Gtk.ApplicationWindow):
                     self.chats: List[Dict] = pickle.load(f)
             except Exception as e:
                 logging.error(f"Error loading chat history: {e}")
-                self.chats: List[Dict] = [{"name": _("Chat ") + "1", "chat": []}]
+                self.chats: List[Dict] = [self.create_chat(_("Chat ") + "1")]
         else:
-            self.chats: List[Dict] = [{"name": _("Chat ") + "1", "chat": []}]
+            self.chats: List[Dict] = [self.create_chat(_("Chat ") + "1")]
+        for chat in self.chats:
+            # Chats saved before they had an id
+            chat.setdefault("id", uuid.uuid4().hex)
+
+    @staticmethod
+    def create_chat(name: str) -> Dict:
+        """Return a new empty chat, its id stays the same when it is renamed"""
+        return {"id": uuid.uuid4().hex, "name": name, "chat": []}
 
     def _init_settings(self):
         settings: Gio.Settings = Gio.Settings.new('io.github.qwersyk.Newelle')
@@ -90,12 +188,17 @@ class MainWindow(Gtk.ApplicationWindow):
         self.left_panel_back_button.set_child(box)
         self.left_panel_back_button.connect("clicked", self.go_back_to_chats_panel)
         self.chat_header.pack_start(self.left_panel_back_button)
+        self.model_loading_box = Gtk.Box(spacing=6, visible=False)
+        self.model_loading_box.append(Gtk.Spinner(spinning=True))
+        self.model_loading_box.append(Gtk.Label(label=_("Warming up the model..."), css_classes=["dim-label"]))
+        self.chat_header.pack_start(self.model_loading_box)
         self.chat_block.append(self.chat_header)
         self.chat_block.append(Gtk.Separator())
         self.chat_panel.append(self.chat_block)
         self.chat_panel.append(Gtk.Separator())
         self.main = Adw.Leaflet(fold_threshold_policy=True, can_navigate_back=True, can_navigate_forward=True)
-        self.streams = []
+        # Console jobs, main and the thread editing window use them like processes
+        self.streams: List[ConsoleJob] = self.job_scheduler.jobs
         self.chats_main_box = Gtk.Box(hexpand_set=True)
         self.chats_main_box.set_size_request(300, -1)
         self.chats_secondary_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, hexpand=True)
@@ -104,8 +207,13 @@ class MainWindow(Gtk.ApplicationWindow):
         self.chats_secondary_box.append(self.chat_panel_header)
         self.chats_secondary_box.append(Gtk.Separator())
         self.chat_panel_header.pack_end(menu_button)
-        self.chats_buttons_block = Gtk.ListBox(css_classes=["separators", "background"])
-        self.chats_buttons_block.set_selection_mode(Gtk.SelectionMode.NONE)
+        # History rows are only built for the visible chats, update_history splices the changed ones
+        self.history_store = Gio.ListStore(item_type=ChatHistoryItem)
+        history_factory = Gtk.SignalListItemFactory()
+        history_factory.connect("setup", self._on_history_row_setup)
+        history_factory.connect("bind", self._on_history_row_bind)
+        self.chats_buttons_block = Gtk.ListView(model=Gtk.NoSelection(model=self.history_store),
+                                                factory=history_factory, css_classes=["separators", "background"])
         self.chats_buttons_scroll_block = Gtk.ScrolledWindow(vexpand=True)
         self.chats_buttons_scroll_block.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
         self.chats_buttons_scroll_block.set_child(self.chats_buttons_block)
@@ -126,24 +234,40 @@ class MainWindow(Gtk.ApplicationWindow):
         self.explorer_panel.append(self.explorer_panel_header)
         self.folder_blocks_panel = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         self.explorer_panel.append(self.folder_blocks_panel)
+        # Only the visible tiles exist, they are recycled while scrolling
+        self.explorer_store = Gio.ListStore(item_type=ExplorerItem)
+        self.explorer_cancellable: Gio.Cancellable | None = None
+        self.explorer_items: Dict[str, ExplorerItem] = {}
+        self.explorer_monitor: Gio.FileMonitor | None = None
+        self.explorer_changes: set = set()
+        self.explorer_flush_id: int = 0
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self._on_explorer_tile_setup)
+        factory.connect("bind", self._on_explorer_tile_bind)
+        self.explorer_grid = Gtk.GridView(model=Gtk.NoSelection(model=self.explorer_store), factory=factory,
+                                          single_click_activate=True, max_columns=8, css_classes=["navigation-sidebar"])
+        self.explorer_grid.connect("activate", self._on_explorer_tile_activate)
+        self.folder_blocks_panel.append(Gtk.ScrolledWindow(child=self.explorer_grid, vexpand=True,
+                                                           hscrollbar_policy=Gtk.PolicyType.NEVER))
         self.set_child(self.main_program_block)
         self.main_program_block.set_content(self.main)
         self.main_program_block.set_flap(self.explorer_panel)
         self.secondary_message_chat_block = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=2)
         self.chat_block.append(self.secondary_message_chat_block)
-        self.chat_list_block = Gtk.ListBox(css_classes=["separators", "background", "view"])
-        self.chat_list_block.set_selection_mode(Gtk.SelectionMode.NONE)
+        # The chat list must be the direct child of the scrolled window, so that only visible messages get widgets
+        self.chat_list_block = ChatView(self.build_message_widget, css_classes=["background", "view"])
         self.chat_scroll = Gtk.ScrolledWindow(vexpand=True)
-        self.chat_scroll_window = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, css_classes=["background", "view"])
-        self.chat_scroll.set_child(self.chat_scroll_window)
+        self.chat_scroll_window = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, css_classes=["background", "view"],
+                                          vexpand=False)
+        self.chat_scroll.set_child(self.chat_list_block)
         drop_target = Gtk.DropTarget.new(GObject.TYPE_STRING, Gdk.DragAction.COPY)
         drop_target.connect('drop', self.handle_file_drag)
         self.chat_scroll.add_controller(drop_target)
         self.chat_scroll.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
-        self.chat_scroll_window.append(self.chat_list_block)
         self.notification_block = Adw.ToastOverlay()
         self.notification_block.set_child(self.chat_scroll)
         self.secondary_message_chat_block.append(self.notification_block)
+        self.secondary_message_chat_block.append(self.chat_scroll_window)
         self.offers_entry_block = Gtk.Box(orientation=Gtk.Orientation.VERTICAL,
                                           spacing=6, valign=Gtk.Align.END, halign=Gtk.Align.FILL, margin_bottom=6)
         self.chat_scroll_window.append(self.offers_entry_block)
@@ -243,6 +367,16 @@ class MainWindow(Gtk.ApplicationWindow):
         self.regenerate_message_button.connect("clicked", self.regenerate_message)
         self.regenerate_message_button.set_visible(False)
         self.chat_controls_entry_block.append(self.regenerate_message_button)
+        self.alternatives_switcher = Gtk.Box(css_classes=["linked"], visible=False)
+        button = Gtk.Button(css_classes=["flat"], icon_name="go-previous-symbolic")
+        button.connect("clicked", self.switch_alternative, -1)
+        self.alternatives_switcher.append(button)
+        self.alternatives_label = Gtk.Label(css_classes=["dim-label"], margin_start=6, margin_end=6)
+        self.alternatives_switcher.append(self.alternatives_label)
+        button = Gtk.Button(css_classes=["flat"], icon_name="go-next-symbolic")
+        button.connect("clicked", self.switch_alternative, 1)
+        self.alternatives_switcher.append(button)
+        self.chat_controls_entry_block.append(self.alternatives_switcher)
         input_box = Gtk.Box(halign=Gtk.Align.FILL, margin_start=6, margin_end=6, margin_top=6, margin_bottom=6,
                             spacing=6)
         input_box.set_valign(Gtk.Align.CENTER)
@@ -270,6 +404,12 @@ class MainWindow(Gtk.ApplicationWindow):
         self.secondary_message_chat_block.append(Gtk.Separator())
         self.secondary_message_chat_block.append(input_box)
         self.stream_number_variable: int = 0
+        # Answer being streamed, its row keeps the same widget until the answer is complete
+        self.streaming_message: Dict | None = None
+        self.streaming_widget: Gtk.Box | None = None
+        self.streaming_box: StreamingMessageBox | None = None
+        self.streaming_text: str = ""
+        self.streaming_update_queued: bool = False
 
     def show_presentation_window(self):
         self.presentation_dialog = PresentationWindow("presentation", self.settings, self.directory, self)
@@ -319,6 +459,9 @@ class MainWindow(Gtk.ApplicationWindow):
         self.chat_id: int = settings.get_int("chat")
         self.main_path: str = settings.get_string("path")
         self.auto_run: bool = settings.get_boolean("auto-run")
+        self.console_session: bool = settings.get_boolean("console-session")
+        self.console_timeout: int = settings.get_int("console-timeout")
+        self.job_scheduler.set_max_jobs(settings.get_int("console-jobs"))
         self.chat: List[Dict] = self.chats[min(self.chat_id, len(self.chats) - 1)]["chat"]
         self.graphic: bool = settings.get_boolean("graphic")
         self.cutom_extra_prompt: bool = settings.get_boolean("custom-extra-prompt")
@@ -336,6 +479,7 @@ class MainWindow(Gtk.ApplicationWindow):
         self.prompts: Dict[str, str] = override_prompts(self.custom_prompts, PROMPTS)
         self._load_model()
         self._load_extensions()
+        self._load_semantic_memory()
 
     def _load_model(self):
         if self.language_model in AVAILABLE_LLMS:
@@ -344,11 +488,43 @@ class MainWindow(Gtk.ApplicationWindow):
         else:
             mod: Dict = list(AVAILABLE_LLMS.values())[0]
             self.model: LLMHandler = mod["class"](self.settings, os.path.join(self.directory, "models"))
-        self.model.load_model(self.local_model)
+        self.model.usage_tracker = self.usage_tracker
+        if os.getenv("NEWELLE_RECORD_STREAMS"):
+            self.model.recorder = StreamRecorder(os.getenv("NEWELLE_RECORD_STREAMS"))
+        GLib.idle_add(self.preload_model)
         self.bot_prompts: List[str] = [replace_variables(value["prompt"]) for value in self.extensions.values() if value["status"]]
         for prompt in self.bot_prompts:
             self.model.set_history(self.bot_prompts, self)
 
+    def _load_semantic_memory(self):
+        if not self.settings.get_boolean("semantic-memory"):
+            if getattr(self, "semantic_memory", None) is not None:
+                # Turning the memory off forgets the indexed messages
+                self.semantic_memory.clear()
+            self.semantic_memory = None
+            return
+        if not SemanticMemory.is_available():
+            logging.warning("Semantic memory requires numpy, it is disabled")
+            self.semantic_memory = None
+            return
+        if getattr(self, "semantic_memory", None) is None:
+            self.semantic_memory = SemanticMemory(os.path.join(self.path, "memory"))
+            # Index the existing chats in background, only new messages are indexed at send time
+            threading.Thread(target=self.semantic_memory.index_chats, args=(self.chats,), daemon=True).start()
+        self.semantic_memory.token_budget = self.settings.get_int("semantic-memory-tokens")
+
+    def preload_model(self):
+        """Start loading the model in background, messages sent meanwhile wait for this load"""
+        loading = self.model.load_model_async(self.local_model)
+        if not loading.done():
+            self.model_loading_box.set_visible(True)
+        loading.add_done_callback(lambda future: GLib.idle_add(self._on_model_loaded, future))
+
+    def _on_model_loaded(self, loading):
+        self.model_loading_box.set_visible(False)
+        if loading.exception() is not None or loading.result() is False:
+            self.notification_block.add_toast(Adw.Toast(title=_('Could not load the model'), timeout=2))
+
     def _load_extensions(self):
         self.extensions: Dict[str, Dict] = {}
         extension_path: str = os.path.expanduser("~") + "/.var/app/io.github.qwersyk.Newelle/extension"
@@ -376,6 +552,318 @@ class MainWindow(Gtk.ApplicationWindow):
             self.tts.connect('start', lambda: GLib.idle_add(self.mute_tts_button.set_visible, True))
             self.tts.connect('stop', lambda: GLib.idle_add(self.mute_tts_button.set_visible, False))
 
+    def on_stream_block(self, block_type: str, content: str, stream_number: int | None = None):
+        """Called from the generation thread as soon as a block of the answer is closed.
+
+        With auto-run, console commands start running and images start decoding before the answer is complete,
+        the console results are then taken with take_early_console_result.
+        """
+        if block_type == "console":
+            future: Future | None = None
+            if self.auto_run and content.strip():
+                future = self.console_executor(self.chats[self.chat_id]).submit(
+                    self.execute_terminal_command, content.split("\n"), None, stream_number)
+            self.early_console_results.append((content, future))
+        elif block_type == "image":
+            self.thumbnails.prefetch(content.strip(), CHAT_IMAGE_SIZE)
+
+    def console_executor(self, chat: Dict) -> ThreadPoolExecutor:
+        """Return the executor running the console blocks of a chat one at a time, in order"""
+        executor: ThreadPoolExecutor | None = self.console_executors.get(id(chat))
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="console-blocks")
+            self.console_executors[id(chat)] = executor
+        return executor
+
+    def execute_terminal_command(self, command: List[str], output: OutputRingBuffer | None = None,
+                                 stream_number: int | None = None) -> Tuple[bool, str]:
+        """Run a console block in main_path, streaming stdout and stderr to output as they are written.
+
+        Returns whether the command succeeded and the output kept by the ring buffer, that is bounded
+        so that long outputs do not end up whole in the chat. The blocks of an answer pass its stream_number,
+        they do not start once the answer is stopped and stop_chat terminates them.
+        """
+        if output is None:
+            output = OutputRingBuffer()
+        path: str = os.path.expanduser(self.main_path)
+        script: str = "\n".join(command)
+        if stream_number is None:
+            job: ConsoleJob = self.job_scheduler.submit(script, output)
+        else:
+            with self.answer_jobs_lock:
+                if self.stream_number_variable != stream_number:
+                    return False, ""
+                job = self.job_scheduler.submit(script, output)
+                self.answer_jobs.append(job)
+        if self.console_session:
+            self.job_scheduler.run(job, functools.partial(self._run_in_session, chat=self.chats[self.chat_id],
+                                                          script=script, path=path))
+        else:
+            arguments: List[str] = ["bash", "-c", script]
+            if not self.virtualization:
+                arguments = ["flatpak-spawn", "--host", "--directory=" + path] + arguments
+            self.job_scheduler.run(job, functools.partial(run_process, arguments=arguments, cwd=path))
+        output.close()
+        text: str = output.text()
+        if job.returncode == 0 and not text.strip():
+            text = "Done"
+        return job.returncode == 0, text
+
+    def _run_in_session(self, job: ConsoleJob, chat: Dict, script: str, path: str) -> int:
+        session: ShellSession | None = self.shell_sessions.get(id(chat))
+        if session is None or session.host == self.virtualization:
+            if session is not None:
+                # Virtualization changed, the commands must run on the other side of the sandbox
+                session.kill()
+            session = ShellSession(host=not self.virtualization)
+            self.shell_sessions[id(chat)] = session
+        job.stop = session.kill
+        status, cwd = session.run(script, job.output, path, self.console_timeout)
+        if cwd is not None and cwd != path and os.path.isdir(cwd):
+            # A cd in the session moves the explorer too
+            self.main_path = cwd
+            GLib.idle_add(self.update_folder)
+        return status
+
+    def take_early_console_result(self, index: int, command: str) -> Tuple[bool, str] | None:
+        """Return the result of the index-th console block of the answer if on_stream_block ran it, waiting for it"""
+        if index >= len(self.early_console_results):
+            return None
+        content, future = self.early_console_results[index]
+        if future is None or content != command or future.cancelled():
+            return None
+        return future.result()
+
+    def get_system_prompts(self) -> List[str]:
+        """Prompts of the extensions and of the enabled features, sent with every message"""
+        prompts: List[str] = list(self.bot_prompts)
+        for prompt in AVAILABLE_PROMPTS:
+            text: str = self.prompts.get(prompt["key"], "")
+            if text and self.settings.get_boolean(prompt["setting_name"]):
+                prompts.append(text.replace("{DIR}", os.path.expanduser(self.main_path)))
+        return prompts
+
+    def on_entry_activate(self, entry: MultilineEntry):
+        if not self.status:
+            self.notification_block.add_toast(Adw.Toast(title=_('The message cannot be sent until the program is finished'), timeout=2))
+            return
+        text: str = entry.get_text().strip()
+        if not text:
+            return
+        entry.set_text("")
+        self.send_user_message(text)
+
+    def send_user_message(self, text: str):
+        self.chat.append({"User": "User", "Message": text})
+        self.chat_list_block.append_message(self.chat[-1])
+        self.status = False
+        self.update_button_text()
+        self.send_button_start_spinner()
+        self.scrolled_chat()
+        threading.Thread(target=self.send_message).start()
+
+    def send_message(self):
+        """Generate the answer to the last message of the chat, called in a worker thread.
+
+        Streamed answers are shown as they arrive in a StreamingMessageBox, and their blocks are passed to
+        on_stream_block as soon as they close. With auto-run the console blocks of the answer are run,
+        usually while it is still streaming, and an answer is generated again with their output.
+        """
+        self.stream_number_variable += 1
+        stream_number: int = self.stream_number_variable
+        self.status = False
+        GLib.idle_add(self.update_button_text)
+        try:
+            while self.stream_number_variable == stream_number:
+                answer: Dict | None = self._generate_answer(stream_number)
+                if answer is None or not self._run_answer_console_blocks(answer, stream_number):
+                    break
+        except Exception as e:
+            logging.error(f"Error sending message: {e}")
+            GLib.idle_add(self.stop_chat)
+            return
+        if self.stream_number_variable != stream_number:
+            # Stopped, stop_chat already restored the chat
+            return
+        self.status = True
+        GLib.idle_add(self.remove_send_button_spinner)
+        GLib.idle_add(self.update_button_text)
+        if self.offers > 0:
+            # Every suggestion is shown as soon as it is parsed, get_suggestions stops if a message is sent
+            try:
+                self.model.get_suggestions(self.prompts["get_suggestions_prompt"], self.offers,
+                                           on_suggestion=lambda s: GLib.idle_add(self._show_suggestion, stream_number, s),
+                                           chat=self.chats[self.chat_id])
+            except Exception as e:
+                logging.error(f"Error getting suggestions: {e}")
+
+    def send_bot_response(self, button: Gtk.Button):
+        if not self.status:
+            return
+        self.send_user_message(button.get_child().get_label())
+
+    def _show_suggestion(self, stream_number: int, text: str):
+        """Show a suggestion in the first hidden suggestion button, unless another message was sent"""
+        if self.stream_number_variable != stream_number or not self.status:
+            return False
+        for button in self.message_suggestion_buttons_array:
+            if not button.get_visible():
+                button.get_child().set_label(text)
+                button.set_visible(True)
+                break
+        return False
+
+    def _generate_answer(self, stream_number: int) -> Dict | None:
+        """Generate and show the answer to the last message, None if the generation was stopped"""
+        self.model.set_history(self.get_system_prompts(), self)
+        prompt: str = self.chat[-1]["Message"]
+        message: Dict = {"User": "Assistant", "Message": ""}
+        self.early_console_results = []
+        with self.answer_jobs_lock:
+            self.answer_jobs = []
+        if self.model.stream_enabled():
+            self.streaming_text = ""
+            GLib.idle_add(self._start_streaming, message, len(self.chat) + 1, stream_number)
+            on_update: Callable[..., Any] = self._streaming_updater(stream_number)
+
+            def on_block(block_type: str, content: str):
+                if self.stream_number_variable == stream_number:
+                    self.on_stream_block(block_type, content, stream_number)
+
+            message["Message"] = self.model.send_message_stream(self, prompt, on_update, on_block=on_block)
+        else:
+            message["Message"] = self.model.send_message(self, prompt)
+        if self.stream_number_variable != stream_number:
+            return None
+        if self.model.last_usage is not None:
+            message["Usage"] = self.model.last_usage
+        self.chat.append(message)
+        GLib.idle_add(self._show_answer, message, stream_number)
+        if self.tts_enabled and message["Message"].strip():
+            # Code blocks are not read
+            text: str = CODE_BLOCK_REGEX.sub("", message["Message"])
+            threading.Thread(target=self.tts.play_audio, args=(text,)).start()
+        return message
+
+    def _run_answer_console_blocks(self, message: Dict, stream_number: int) -> bool:
+        """With auto-run, add the output of the console blocks of the answer to the chat.
+
+        The blocks were usually started by on_stream_block while the answer streamed, their results are
+        taken from there. Returns whether any block ran, so that the model answers again with the output.
+        """
+        if not self.auto_run:
+            return False
+        index: int = len(self.chat) - 1
+        ran: bool = False
+        # Parsed like while streaming, so that the blocks match the ones on_stream_block received
+        parser = StreamingBlockParser(("console",))
+        blocks: List[Tuple[str, str]] = parser.feed(message["Message"]) + parser.finish()
+        for i, (_type, content) in enumerate(blocks):
+            if not content.strip():
+                continue
+            result: Tuple[bool, str] | None = self.take_early_console_result(i, content)
+            if result is None:
+                result = self.execute_terminal_command(content.split("\n"), stream_number=stream_number)
+            if self.stream_number_variable != stream_number:
+                return False
+            self.chat.append({"User": "Console", "Message": " " + result[1]})
+            ran = True
+        if ran:
+            GLib.idle_add(self._show_console_results, index, stream_number)
+        return ran
+
+    def _streaming_updater(self, stream_number: int) -> Callable[..., Any]:
+        """Return the on_update showing a streamed answer, it stops the generation once stale"""
+        def on_update(text: str, *a):
+            if self.stream_number_variable != stream_number:
+                return False
+            self.streaming_text = text
+            if not self.streaming_update_queued:
+                self.streaming_update_queued = True
+                GLib.idle_add(self._update_streaming)
+        return on_update
+
+    def _start_streaming(self, message: Dict, id_message: int, stream_number: int, replace: bool = False):
+        """Show the message being streamed in a new row, or in place of the last one with replace"""
+        if self.stream_number_variable != stream_number:
+            return False
+        self.streaming_message = message
+        self.streaming_widget = self._message_box(message)
+        self.streaming_box = StreamingMessageBox(parent=self, id_message=id_message)
+        self.streaming_widget.append(self.streaming_box)
+        if replace:
+            self.chat_list_block.update_message(id_message - 1, message)
+        else:
+            self.chat_list_block.append_message(message)
+        self.scrolled_chat()
+        return False
+
+    def _update_streaming(self):
+        self.streaming_update_queued = False
+        if self.streaming_box is not None:
+            self.streaming_box.update(self.streaming_text)
+            self.scrolled_chat()
+        return False
+
+    def _end_streaming(self):
+        self.streaming_message = self.streaming_widget = self.streaming_box = None
+
+    def _show_answer(self, message: Dict, stream_number: int):
+        if self.stream_number_variable != stream_number:
+            return False
+        if message is self.streaming_message:
+            # The row already shows the answer, it is only completed
+            self.streaming_box.finish(message["Message"])
+            self._end_streaming()
+        else:
+            self.chat_list_block.append_message(message)
+        self.scrolled_chat()
+        return False
+
+    def _show_console_results(self, index: int, stream_number: int):
+        if self.stream_number_variable != stream_number:
+            return False
+        for message in self.chat[self.chat_list_block.store.get_n_items():]:
+            self.chat_list_block.append_message(message)
+        # The console blocks of the answer show the output added after it
+        self.chat_list_block.update_message(index, self.chat[index])
+        return False
+
+    def stop_chat(self, button: Gtk.Button | None = None):
+        """Stop the answer being generated, it is not added to the chat"""
+        self.stream_number_variable += 1
+        self.status = True
+        for _content, future in self.early_console_results:
+            if future is not None:
+                future.cancel()
+        self.early_console_results = []
+        # Cancelling a future does not stop a command that already started
+        threading.Thread(target=self._terminate_answer_jobs, daemon=True).start()
+        self._end_streaming()
+        self.remove_send_button_spinner()
+        self.show_chat()
+        if button is not None:
+            self.notification_block.add_toast(Adw.Toast(title=_('The message was canceled and deleted from history'), timeout=2))
+
+    def _terminate_answer_jobs(self):
+        with self.answer_jobs_lock:
+            for job in self.answer_jobs:
+                job.terminate()
+            self.answer_jobs = []
+
+    def update_button_text(self):
+        """Show the chat controls that can be used while a message is, or is not, being generated"""
+        last_user: str | None = self.chat[-1]["User"] if self.chat else None
+        self.chat_stop_button.set_visible(not self.status)
+        self.button_clear.set_visible(self.status and bool(self.chat))
+        self.button_continue.set_visible(self.status and last_user in ["Assistant", "Console"])
+        self.regenerate_message_button.set_visible(self.status and last_user == "Assistant")
+        if not self.status:
+            for button in self.message_suggestion_buttons_array:
+                button.set_visible(False)
+        self.update_alternatives_switcher()
+        return False
+
     def send_button_start_spinner(self):
         spinner = Gtk.Spinner(spinning=True)
         self.send_button.set_child(spinner)
@@ -433,7 +921,9 @@ class MainWindow(Gtk.ApplicationWindow):
         return button
 
     def run_file_on_button_click(self, button: Gtk.Button, *a):
-        path: str = button.get_name()
+        self.open_path(button.get_name())
+
+    def open_path(self, path: str):
         if os.path.exists(path):
             if os.path.isdir(path):
                 self.main_path = path
@@ -462,6 +952,164 @@ class MainWindow(Gtk.ApplicationWindow):
                 self.notification_block.add_toast(Adw.Toast(title=_('The file is not recognized'), timeout=2))
         return True
 
+    def update_folder(self, *a):
+        """Show the files of main_path, enumerating them asynchronously in batches.
+
+        Navigating again cancels the enumeration still running, so a slow folder never fills the new one.
+        """
+        if self.explorer_cancellable is not None:
+            self.explorer_cancellable.cancel()
+        if self.explorer_monitor is not None:
+            self.explorer_monitor.cancel()
+            self.explorer_monitor = None
+        if self.explorer_flush_id:
+            GLib.source_remove(self.explorer_flush_id)
+            self.explorer_flush_id = 0
+        cancellable = Gio.Cancellable()
+        self.explorer_cancellable = cancellable
+        self.explorer_store.remove_all()
+        self.explorer_items = {}
+        self.explorer_changes = set()
+        self.check_streams["folder"] = True
+        folder = Gio.File.new_for_path(os.path.expanduser(self.main_path))
+        # Started before listing, so that the files changed while listing are not missed
+        try:
+            self.explorer_monitor = folder.monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, cancellable)
+            self.explorer_monitor.connect("changed", self._on_folder_changed, folder)
+        except GLib.Error as e:
+            logging.warning(f"Cannot watch {folder.get_path()}, it will only be updated on reload: {e.message}")
+        folder.enumerate_children_async(EXPLORER_ATTRIBUTES, Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_DEFAULT,
+                                        cancellable, self._on_folder_enumerated, (folder, cancellable))
+        return False
+
+    def _on_folder_enumerated(self, source: Gio.File, result: Gio.AsyncResult, data: Tuple):
+        folder, cancellable = data
+        try:
+            enumerator: Gio.FileEnumerator = source.enumerate_children_finish(result)
+        except GLib.Error as e:
+            if not cancellable.is_cancelled():
+                logging.error(f"Error listing {folder.get_path()}: {e.message}")
+                self.check_streams["folder"] = False
+                self.notification_block.add_toast(Adw.Toast(title=_('Error opening folder'), timeout=2))
+            return
+        enumerator.next_files_async(EXPLORER_BATCH_SIZE, GLib.PRIORITY_DEFAULT, cancellable,
+                                    self._on_folder_files, (folder, cancellable))
+
+    def _on_folder_files(self, enumerator: Gio.FileEnumerator, result: Gio.AsyncResult, data: Tuple):
+        folder, cancellable = data
+        try:
+            infos: List[Gio.FileInfo] = enumerator.next_files_finish(result)
+        except GLib.Error as e:
+            infos = []
+            if not cancellable.is_cancelled():
+                logging.error(f"Error listing {folder.get_path()}: {e.message}")
+        if cancellable.is_cancelled() or not infos:
+            enumerator.close_async(GLib.PRIORITY_DEFAULT, None, None)
+            if not cancellable.is_cancelled():
+                # Sorted once at the end, sorting every batch would move the tiles at each one
+                self.explorer_store.sort(self._compare_explorer_items)
+                self.check_streams["folder"] = False
+            return
+        path: str = folder.get_path()
+        items: List[ExplorerItem] = []
+        for info in infos:
+            # Files already added by a change event are skipped
+            if (self.hidden_files or not info.get_is_hidden()) and info.get_name() not in self.explorer_items:
+                item = ExplorerItem(path, info.get_name(), info.get_file_type() == Gio.FileType.DIRECTORY)
+                self.explorer_items[item.name] = item
+                items.append(item)
+        self.explorer_store.splice(self.explorer_store.get_n_items(), 0, items)
+        enumerator.next_files_async(EXPLORER_BATCH_SIZE, GLib.PRIORITY_DEFAULT, cancellable,
+                                    self._on_folder_files, data)
+
+    def _on_folder_changed(self, monitor: Gio.FileMonitor, file: Gio.File, other_file: Gio.File | None,
+                           event: Gio.FileMonitorEvent, folder: Gio.File):
+        """Collect the names of the changed files, bursts like a git checkout are applied together"""
+        if event not in (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.RENAMED,
+                         Gio.FileMonitorEvent.MOVED_IN, Gio.FileMonitorEvent.MOVED_OUT):
+            return
+        self.explorer_changes.add(file.get_basename())
+        if event == Gio.FileMonitorEvent.RENAMED and other_file is not None:
+            self.explorer_changes.add(other_file.get_basename())
+        if not self.explorer_flush_id:
+            self.explorer_flush_id = GLib.timeout_add(EXPLORER_COALESCE_DELAY, self._apply_folder_changes, folder)
+
+    def _apply_folder_changes(self, folder: Gio.File):
+        self.explorer_flush_id = 0
+        changes, self.explorer_changes = self.explorer_changes, set()
+        if len(changes) > EXPLORER_MAX_CHANGES:
+            self.update_folder()
+            return False
+        cancellable = self.explorer_cancellable
+        # Each file is queried again, so only its final state matters however many events it received
+        for name in changes:
+            folder.get_child(name).query_info_async(EXPLORER_ATTRIBUTES, Gio.FileQueryInfoFlags.NONE,
+                                                    GLib.PRIORITY_DEFAULT, cancellable,
+                                                    self._on_changed_file_queried, (folder, name, cancellable))
+        return False
+
+    def _on_changed_file_queried(self, file: Gio.File, result: Gio.AsyncResult, data: Tuple):
+        folder, name, cancellable = data
+        if cancellable.is_cancelled():
+            return
+        try:
+            info: Gio.FileInfo | None = file.query_info_finish(result)
+        except GLib.Error:
+            info = None
+        old_item: ExplorerItem | None = self.explorer_items.pop(name, None)
+        if old_item is not None:
+            found, position = self.explorer_store.find(old_item)
+            if found:
+                self.explorer_store.remove(position)
+        if info is None or (info.get_is_hidden() and not self.hidden_files):
+            return
+        item = ExplorerItem(folder.get_path(), name, info.get_file_type() == Gio.FileType.DIRECTORY)
+        self.explorer_items[name] = item
+        if self.check_streams["folder"]:
+            # Still listing, the store is sorted at the end
+            self.explorer_store.append(item)
+        else:
+            self.explorer_store.insert_sorted(item, self._compare_explorer_items)
+
+    @staticmethod
+    def _compare_explorer_items(a: ExplorerItem, b: ExplorerItem) -> int:
+        key_a, key_b = (not a.is_dir, a.name.lower()), (not b.is_dir, b.name.lower())
+        return (key_a > key_b) - (key_a < key_b)
+
+    def _on_explorer_tile_setup(self, factory: Gtk.SignalListItemFactory, list_item: Gtk.ListItem):
+        icon = File("~", "")
+        icon.set_css_classes(["large"])
+        icon.set_valign(Gtk.Align.END)
+        icon.set_vexpand(True)
+        file_label = Gtk.Label(css_classes=["title-3"], halign=Gtk.Align.START, wrap=True,
+                               wrap_mode=Pango.WrapMode.WORD_CHAR)
+        file_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6, margin_top=5, margin_start=5,
+                           margin_bottom=5, margin_end=5)
+        file_box.append(icon)
+        file_box.set_size_request(110, 110)
+        file_box.append(file_label)
+        list_item.set_child(file_box)
+
+    def _on_explorer_tile_bind(self, factory: Gtk.SignalListItemFactory, list_item: Gtk.ListItem):
+        item: ExplorerItem = list_item.get_item()
+        file_box: Gtk.Box = list_item.get_child()
+        icon: File = file_box.get_first_child()
+        icon.set_file(item.path, item.name, item.is_dir)
+        icon.get_next_sibling().set_label(item.name)
+        if not item.is_dir and ThumbnailCache.is_image(item.name):
+            self.thumbnails.load(os.path.join(item.path, item.name), EXPLORER_THUMBNAIL_SIZE,
+                                 functools.partial(self._on_explorer_thumbnail, icon, item))
+
+    @staticmethod
+    def _on_explorer_thumbnail(icon: File, item: ExplorerItem, texture: Gdk.Texture | None):
+        # The tile may have been recycled for another file while the image was decoded
+        if texture is not None and icon.path == item.path and icon.file_name == item.name:
+            icon.set_from_paintable(texture)
+
+    def _on_explorer_tile_activate(self, grid: Gtk.GridView, position: int):
+        item: ExplorerItem = self.explorer_store.get_item(position)
+        self.open_path(os.path.join(item.path, item.name))
+
     def go_back_in_explorer_panel(self, *a):
         self.main_path = os.path.normpath(self.main_path + "/..")
         GLib.idle_add(self.update_folder)
@@ -481,6 +1129,162 @@ class MainWindow(Gtk.ApplicationWindow):
     def return_to_chat_panel(self, button: Gtk.Button):
         self.main.set_visible_child(self.chat_panel)
 
+    def update_history(self):
+        """Update the history to match self.chats, only the chats that changed get their row rebuilt"""
+        shown: List[Dict] = [self.history_store.get_item(i).chat for i in range(self.history_store.get_n_items())]
+        start: int = 0
+        while start < min(len(shown), len(self.chats)) and shown[start] is self.chats[start]:
+            start += 1
+        end_shown, end_chats = len(shown), len(self.chats)
+        while end_shown > start and end_chats > start and shown[end_shown - 1] is self.chats[end_chats - 1]:
+            end_shown -= 1
+            end_chats -= 1
+        if start != end_shown or start != end_chats:
+            self.history_store.splice(start, end_shown - start,
+                                      [ChatHistoryItem(chat) for chat in self.chats[start:end_chats]])
+
+    def update_history_row(self, chat_id: int):
+        """Rebuild the row of a chat after it was renamed or selected"""
+        if chat_id < self.history_store.get_n_items():
+            self.history_store.splice(chat_id, 1, [ChatHistoryItem(self.chats[chat_id])])
+
+    def _on_history_row_setup(self, factory: Gtk.SignalListItemFactory, list_item: Gtk.ListItem):
+        list_item.set_activatable(False)
+        box = Gtk.Box(spacing=6, margin_top=3, margin_bottom=3, margin_start=6, margin_end=6)
+        button = Gtk.Button(css_classes=["flat"], hexpand=True)
+        button.set_child(Gtk.Label(ellipsize=Pango.EllipsizeMode.END, halign=Gtk.Align.START))
+        button.connect("clicked", self.choose_chat, list_item)
+        box.append(button)
+        delete_button = Gtk.Button(css_classes=["flat", "error"], icon_name="user-trash-symbolic",
+                                   valign=Gtk.Align.CENTER)
+        delete_button.connect("clicked", self.remove_chat, list_item)
+        box.append(delete_button)
+        list_item.set_child(box)
+
+    def _on_history_row_bind(self, factory: Gtk.SignalListItemFactory, list_item: Gtk.ListItem):
+        chat: Dict = list_item.get_item().chat
+        button: Gtk.Button = list_item.get_child().get_first_child()
+        button.get_child().set_label(chat["name"])
+        if chat is self.chats[min(self.chat_id, len(self.chats) - 1)]:
+            button.add_css_class("accent")
+        else:
+            button.remove_css_class("accent")
+
+    def choose_chat(self, button: Gtk.Button, list_item: Gtk.ListItem):
+        if not self.status:
+            self.notification_block.add_toast(Adw.Toast(title=_('The chat cannot be changed until the program is finished'), timeout=2))
+            return
+        previous: int = self.chat_id
+        self.chat_id = list_item.get_position()
+        self.chat = self.chats[self.chat_id]["chat"]
+        self.update_history_row(previous)
+        self.update_history_row(self.chat_id)
+        self.show_chat()
+
+    def remove_chat(self, button: Gtk.Button, list_item: Gtk.ListItem):
+        if not self.status:
+            self.notification_block.add_toast(Adw.Toast(title=_('The chat cannot be deleted until the program is finished'), timeout=2))
+            return
+        chat_id: int = list_item.get_position()
+        session: ShellSession | None = self.shell_sessions.pop(id(self.chats[chat_id]), None)
+        if session is not None:
+            session.kill()
+        executor: ThreadPoolExecutor | None = self.console_executors.pop(id(self.chats[chat_id]), None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.chats.pop(chat_id)
+        self.history_store.remove(chat_id)
+        if self.semantic_memory is not None:
+            # The messages are copied, the chats can change while the index is rewritten
+            chats: List[Dict] = [{"chat": list(chat["chat"])} for chat in self.chats]
+            threading.Thread(target=self.semantic_memory.prune, args=(chats,), daemon=True).start()
+        if not self.chats:
+            self.chats.append(self.create_chat(_("Chat ") + "1"))
+            self.history_store.append(ChatHistoryItem(self.chats[0]))
+        if chat_id < self.chat_id:
+            self.chat_id -= 1
+        elif chat_id == self.chat_id:
+            self.chat_id = min(self.chat_id, len(self.chats) - 1)
+            self.chat = self.chats[self.chat_id]["chat"]
+            self.update_history_row(self.chat_id)
+            self.show_chat()
+
+    def new_chat(self, *a):
+        if not self.status:
+            self.notification_block.add_toast(Adw.Toast(title=_('A new chat cannot be created until the program is finished'), timeout=2))
+            return
+        self.chats.append(self.create_chat(_("Chat ") + str(len(self.chats) + 1)))
+        self.history_store.append(ChatHistoryItem(self.chats[-1]))
+        previous: int = self.chat_id
+        self.chat_id = len(self.chats) - 1
+        self.chat = self.chats[self.chat_id]["chat"]
+        self.update_history_row(previous)
+        self.update_history_row(self.chat_id)
+        self.show_chat()
+
+    def show_chat(self):
+        """Show the current chat. Only the list model is rebuilt, widgets are built for the visible messages."""
+        self.chat_list_block.set_messages(self.chat)
+        self.update_button_text()
+        self.scrolled_chat()
+
+    def scrolled_chat(self):
+        GLib.idle_add(self._scroll_chat_to_end)
+
+    def _scroll_chat_to_end(self):
+        adjustment: Gtk.Adjustment = self.chat_scroll.get_vadjustment()
+        adjustment.set_value(adjustment.get_upper())
+
+    def build_message_widget(self, index: int, message: Dict) -> Gtk.Widget | None:
+        """Build the widget of a message of the chat, called only when the message becomes visible"""
+        if message["User"] == "Console":
+            # Console outputs are shown in the console block of the previous message
+            return None
+        if message["User"] in ["File", "Folder"]:
+            return self.get_file_button(message["Message"].strip())
+        if message is self.streaming_message:
+            return self.streaming_widget
+        box: Gtk.Box = self._message_box(message)
+        for part in self.parse_cache.get(message["User"], message["Message"]):
+            if part[0] == "text":
+                box.append(self._message_label(part[1]))
+            elif part[0] == "files":
+                for path in part[1]:
+                    box.append(self.get_file_button(path))
+            elif part[0] == "image" and self.show_image:
+                picture = Gtk.Picture()
+                picture.set_size_request(-1, 300)
+                self.thumbnails.load(part[1].strip(), CHAT_IMAGE_SIZE, picture.set_paintable)
+                box.append(picture)
+            elif part[0] == "chart" and self.graphic:
+                content, values, percentages = part[1:]
+                box.append(BarChartBox(values, percentages) if values else self._message_label(markwon_to_pango(content)))
+            elif part[0] == "code":
+                box.append(CopyBox(part[2], part[1], parent=self, id_message=index + 1))
+            else:
+                # Image and chart blocks are shown as code when they are disabled
+                box.append(CopyBox(part[1], part[0], parent=self, id_message=index + 1))
+        return box
+
+    def _message_box(self, message: Dict) -> Gtk.Box:
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, margin_top=6, margin_bottom=6, margin_start=12,
+                      margin_end=12)
+        name: str = _("User") if message["User"] == "User" else _("Assistant")
+        box.append(Gtk.Label(label=name, css_classes=["heading", "dim-label"], halign=Gtk.Align.START))
+        return box
+
+    def _message_label(self, markup: str) -> Gtk.Label:
+        return Gtk.Label(label=markup, use_markup=True, wrap=True, wrap_mode=Pango.WrapMode.WORD_CHAR,
+                         selectable=True, halign=Gtk.Align.START, xalign=0)
+
+    def save_chat(self):
+        try:
+            with open(os.path.join(self.path, self.filename), 'wb') as f:
+                pickle.dump(self.chats, f)
+        except OSError as e:
+            logging.error(f"Error saving chat history: {e}")
+        self.parse_cache.save()
+
     def continue_message(self, button: Gtk.Button):
         if self.chat and self.chat[-1]["User"] in ["Assistant", "Console", "User"]:
             threading.Thread(target=self.send_message).start()
@@ -489,3 +1293,101 @@ class MainWindow(Gtk.ApplicationWindow):
             self.notification_block.add_toast(Adw.Toast(title=_('You can no longer continue the message.'), timeout=2))
 
     def regenerate_message(self, *a):
+        if not self.status or not self.chat or self.chat[-1]["User"] != "Assistant" or len(self.chat) < 2:
+            self.notification_block.add_toast(Adw.Toast(title=_('You can no longer regenerate the message.'), timeout=2))
+            return
+        self.status = False
+        self.regenerate_message_button.set_sensitive(False)
+        self.send_button_start_spinner()
+        self.stream_number_variable += 1
+        self.update_button_text()
+        threading.Thread(target=self._generate_alternatives, args=(self.chat[-1], self.stream_number_variable)).start()
+
+    def _generate_alternatives(self, message: Dict, stream_number: int):
+        """Generate new answers to the message before the last one, keeping the previous ones as alternatives.
+
+        The first new answer is streamed in place of the one regenerated, the others are added as they arrive.
+        """
+        alternatives: List[str] = message.setdefault("Alternatives", [message["Message"]])
+        start: int = len(alternatives)
+        # The history is built from the chat, so the answer being regenerated is removed while generating
+        self.chat.pop()
+        on_update: Callable[..., Any] = lambda *a: self.stream_number_variable == stream_number
+        if self.model.stream_enabled():
+            self.streaming_text = ""
+            GLib.idle_add(self._start_streaming, {"User": "Assistant", "Message": ""}, len(self.chat) + 1,
+                          stream_number, True)
+            on_update = self._streaming_updater(stream_number)
+        try:
+            self.model.set_history(self.get_system_prompts(), self)
+            candidates: List[str] | str = self.model.send_message_candidates(
+                self, self.chat[-1]["Message"], on_update,
+                lambda i, candidate: GLib.idle_add(self._add_alternative, message, i, candidate, start, stream_number))
+        except Exception as e:
+            logging.error(f"Error generating alternatives: {e}")
+            candidates = f"Error: {e}"
+        finally:
+            self.chat.append(message)
+        GLib.idle_add(self._on_alternatives_generated, message, candidates, start, stream_number,
+                      self.model.last_usage)
+
+    def _add_alternative(self, message: Dict, index: int, candidate: str, start: int, stream_number: int):
+        """Add an answer to the alternatives as soon as it is complete, the first one is the answer shown"""
+        if self.stream_number_variable != stream_number or not candidate.strip() or candidate.startswith("Error"):
+            return False
+        alternatives: List[str] = message["Alternatives"]
+        if index == 0:
+            message["Alternative"] = len(alternatives)
+            message["Message"] = candidate
+        alternatives.append(candidate)
+        self.update_alternatives_switcher(message)
+        return False
+
+    def _on_alternatives_generated(self, message: Dict, candidates: List[str] | str, start: int, stream_number: int,
+                                   usage: Dict | None = None):
+        self._end_streaming()
+        self.regenerate_message_button.set_sensitive(True)
+        if self.stream_number_variable != stream_number:
+            # Stopped while the answer was out of the chat, the answers completed so far are kept
+            self.show_chat()
+            return False
+        self.status = True
+        self.remove_send_button_spinner()
+        alternatives: List[str] = message["Alternatives"]
+        if len(alternatives) == start:
+            # A failed request returns the error as a string instead of the list of candidates
+            if isinstance(candidates, str):
+                candidates = [candidates]
+            errors: List[str] = [candidate for candidate in candidates if candidate.startswith("Error")]
+            title: str = errors[0] if errors else _('No alternative answer was generated.')
+            self.notification_block.add_toast(Adw.Toast(title=GLib.markup_escape_text(title), timeout=3))
+        else:
+            if message.get("Alternative", 0) < start:
+                # The first answer failed, the next one is shown
+                message["Alternative"] = start
+                message["Message"] = alternatives[start]
+            if usage is not None:
+                message["Usage"] = usage
+        self.chats[self.chat_id]["chat"] = self.chat
+        self.show_chat()
+        return False
+
+    def switch_alternative(self, button: Gtk.Button, step: int):
+        """Show the previous or next cached alternative of the last answer, without any request"""
+        if not self.status or not self.chat or "Alternatives" not in self.chat[-1]:
+            return
+        message: Dict = self.chat[-1]
+        message["Alternative"] = (message.get("Alternative", 0) + step) % len(message["Alternatives"])
+        message["Message"] = message["Alternatives"][message["Alternative"]]
+        self.chats[self.chat_id]["chat"] = self.chat
+        self.show_chat()
+        self.update_alternatives_switcher()
+
+    def update_alternatives_switcher(self, message: Dict | None = None):
+        """Show the alternatives of message, by default the last message of the chat"""
+        if message is None and self.chat:
+            message = self.chat[-1]
+        alternatives: List[str] = message.get("Alternatives", []) if message is not None else []
+        self.alternatives_switcher.set_visible(len(alternatives) > 1)
+        if len(alternatives) > 1:
+            self.alternatives_label.set_label(f"{message.get('Alternative', 0) + 1}/{len(alternatives)}")